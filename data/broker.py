@@ -12,7 +12,7 @@ import os
 
 import dramatiq
 
-from tasks.db import init_db
+from tasks.db import flush_data_checks_log, init_db
 
 # Initialize database tables (no-op when DATABASE_URL is unset, e.g. in tests).
 init_db()
@@ -31,6 +31,17 @@ class _SentryMiddleware(dramatiq.Middleware):
             sentry_sdk.capture_exception(exception)
 
 
+class _FlushDataChecksLogMiddleware(dramatiq.Middleware):
+    """Write the check results still buffered for data_checks_log when a worker stops.
+
+    Worker processes aren't guaranteed to run their atexit handlers when dramatiq stops
+    them, so we don't rely on those.
+    """
+
+    def after_worker_shutdown(self, broker, worker):
+        flush_data_checks_log()
+
+
 def _make_broker():
     from dramatiq_redis_streams import StreamsBroker
 
@@ -38,6 +49,7 @@ def _make_broker():
 
     instance = StreamsBroker(**redis_conn.broker_kwargs())
 
+    instance.add_middleware(_FlushDataChecksLogMiddleware())
     if os.getenv("DATA_SENTRY_DSN"):
         instance.add_middleware(_SentryMiddleware())
 
@@ -9,4 +9,7 @@ if os.getenv("DATA_SENTRY_DSN"):
         environment=os.getenv("DATA_SENTRY_ENV"),
         release="st-home-data@" + (os.getenv("GITHUB_SHA") or os.getenv("CONTAINER_VERSION")),
         send_default_pii=True,
+        # Tracing is opt-in. Only long tasks start a transaction (sync.run, with a span
+        # per stage); the stage metrics are logged either way.
+        traces_sample_rate=float(os.getenv("DATA_SENTRY_TRACES_SAMPLE_RATE", "0")),
     )
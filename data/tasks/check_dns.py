@@ -1,6 +1,7 @@
 import logging
 import re
 import sys
+from collections import Counter
 
 import dns.exception
 import dns.resolver
@@ -9,7 +10,13 @@ from sentry_sdk.crons import monitor
 
 from broker import register_task
 
-from .conformance import Issues, data_checks_doable, validate_conformance
+from .conformance import (
+    Issues,
+    data_checks_blocking_issue,
+    data_checks_doable,
+    validate_conformance,
+    validate_conformance_masks,
+)
 from .db import find_org_by_siret, list_all_orgs, upsert_issues
 from .defs import EU_COUNTRIES
 from .lib import geoip_countries_by_hostname
@@ -57,8 +64,24 @@ def run(siret):
     },
 )
 def queue_all():
-    for org in list_all_orgs():
-        run.send(org["siret"])
+    # Only queue the orgs the check can be run on: run() would skip the others
+    orgs = list_all_orgs(columns=["siret", "email_official"])
+    conformance_masks = validate_conformance_masks(
+        [org["email_official"] or "" for org in orgs],
+        [""] * len(orgs),
+    )
+    queued_count = 0
+    skipped_counts = Counter()
+    for org, conformance_mask in zip(orgs, conformance_masks, strict=True):
+        blocking_issue = data_checks_blocking_issue("dns", conformance_mask)
+        if blocking_issue is None:
+            run.send(org["siret"])
+            queued_count += 1
+        else:
+            skipped_counts[str(blocking_issue)] += 1
+
+    logger.info(f"Queued {queued_count} dns checks, skipped: {dict(skipped_counts)}")
+    return {"queued": queued_count, "skipped": dict(skipped_counts)}
 
 
 def check_dns(email_domain):
@@ -96,11 +119,11 @@ def check_dns(email_domain):
             ips = set(ips)
             if len(non_empty_countries) == 0:
                 continue
-            metadata["mx_countries"] = list(non_empty_countries)
+            metadata["mx_countries"] = sorted(non_empty_countries)
             metadata["mx_tld"] = str(
                 _tld_extract(record.exchange.to_text()).top_domain_under_public_suffix
             ).lower()
-            metadata["mx_ips"] = list(ips)
+            metadata["mx_ips"] = sorted(ips)
 
             outside_eu = [
                 country for country in metadata["mx_countries"] if country not in EU_COUNTRIES
@@ -1,6 +1,10 @@
+import datetime
+import http.cookiejar
 import logging
 import re
 import sys
+import threading
+from collections import Counter
 from urllib.parse import urlparse, urlunparse
 
 import requests
@@ -9,8 +13,22 @@ from sentry_sdk.crons import monitor
 
 from broker import register_task
 
-from .conformance import Issues, data_checks_doable, validate_conformance
-from .db import find_org_by_siret, list_all_orgs, upsert_issues
+from .conformance import (
+    Issues,
+    data_checks_blocking_issue,
+    data_checks_doable,
+    validate_conformance,
+    validate_conformance_masks,
+)
+from .db import (
+    clear_dead_host,
+    find_org_by_siret,
+    get_data_check,
+    get_dead_host,
+    list_all_orgs,
+    record_dead_host,
+    upsert_issues,
+)
 from .defs import WEBSITE_REDIRECT_DOMAINS_ALLOWED, WEBSITE_REDIRECT_MAX_HOPS
 
 logger = logging.getLogger(__name__)
@@ -21,6 +39,35 @@ logging.basicConfig(level=logging.INFO)
 # to show more precise errors to users.
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+# Each worker thread keeps its own session, so that the probes of an org (and of the
+# next ones) reuse the connections to the hosts they already reached. Connections made
+# with and without certificate verification are pooled apart by requests (>= 2.32).
+WEBSITE_POOL_HOSTS = 16
+WEBSITE_POOL_SIZE = 2
+# Bodies up to this size are read to keep their connection alive, bigger ones are dropped
+WEBSITE_BODY_DRAIN_MAX = 256 * 1024
+# Timeout of the single probe of a host that timed out on its last check
+WEBSITE_FAST_PROBE_TIMEOUT = 3
+
+_thread_local = threading.local()
+
+
+def get_session():
+    """The requests session of the current thread"""
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        # Probes must stay stateless: cookies set by a site would otherwise be sent back
+        # on the next checks, and could change their redirects and statuses
+        session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=WEBSITE_POOL_HOSTS, pool_maxsize=WEBSITE_POOL_SIZE
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _thread_local.session = session
+    return session
+
 
 @register_task(name="check_website.run", queue="check_website", time_limit=120_000, max_retries=1)
 def run(siret):
@@ -35,7 +82,22 @@ def run(siret):
         if "website" not in data_checks_doable(conformance_issues):
             return
 
-        issues = check_website(org["website_url"])
+        website_url = org["website_url"]
+        host = urlparse(website_url).hostname
+        dead_host = get_dead_host(host)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if dead_host and dead_host["next_check_dt"] > now and not is_reachable(website_url):
+            # Still dead: don't spend a full check on it before its next_check_dt
+            issues = get_dead_host_issues(siret, dead_host)
+        else:
+            timed_out_origins = set()
+            issues = check_website(website_url, timed_out_origins=timed_out_origins)
+            # Only the site's own origin: the other scheme may just be firewalled
+            if url_origin(website_url) in timed_out_origins:
+                record_dead_host(host)
+            elif dead_host:
+                clear_dead_host(host)
+
         if issues is not None:
             upsert_issues(siret, "website", issues, {})
 
@@ -53,14 +115,33 @@ def run(siret):
     },
 )
 def queue_all():
-    for org in list_all_orgs():
-        run.send(org["siret"])
+    # Only queue the orgs the check can be run on: run() would skip the others
+    orgs = list_all_orgs(columns=["siret", "website_url"])
+    conformance_masks = validate_conformance_masks(
+        [""] * len(orgs),
+        [org["website_url"] or "" for org in orgs],
+    )
+    queued_count = 0
+    skipped_counts = Counter()
+    for org, conformance_mask in zip(orgs, conformance_masks, strict=True):
+        blocking_issue = data_checks_blocking_issue("website", conformance_mask)
+        if blocking_issue is None:
+            run.send(org["siret"])
+            queued_count += 1
+        else:
+            skipped_counts[str(blocking_issue)] += 1
 
+    logger.info(f"Queued {queued_count} website checks, skipped: {dict(skipped_counts)}")
+    return {"queued": queued_count, "skipped": dict(skipped_counts)}
 
-def check_website(url, force_http_url=None):
+
+def check_website(url, force_http_url=None, timed_out_origins=None):
     """
     Check website reachability and HTTPS redirect behavior
     Returns a dict of Issues with explanations
+
+    The origins that timed out are added to `timed_out_origins`, if given: the
+    other probes of these origins are then skipped.
     """
     issues = {}
 
@@ -92,6 +173,7 @@ def check_website(url, force_http_url=None):
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/134.0.0.0 Safari/537.3"
         },
         "verify": True,
+        "timed_out_origins": set() if timed_out_origins is None else timed_out_origins,
     }
 
     final_domain_http = check_http(url, urls_to_test, issues, request_kwargs)
@@ -107,6 +189,72 @@ def check_website(url, force_http_url=None):
     return issues
 
 
+def get_dead_host_issues(siret, dead_host):
+    """
+    The issues of a website whose host is still dead. Those of its last check are kept
+    if it found the website down (so that data_checks isn't rewritten), otherwise the
+    website is reported down since the first failure of its host.
+    """
+    last_check = get_data_check(siret, "website")
+    if last_check is not None and Issues.WEBSITE_DOWN.name in last_check["issues"]:
+        try:
+            return {
+                Issues[key]: detail
+                for key, detail in zip(last_check["issues"], last_check["details"], strict=True)
+            }
+        except KeyError:
+            # An issue that doesn't exist anymore
+            pass
+    return {
+        Issues.WEBSITE_DOWN: f"Website unreachable since {dead_host['first_failure_dt']:%Y-%m-%d}"
+    }
+
+
+def url_origin(url):
+    """The (scheme, netloc) of a URL"""
+    parsed = urlparse(url)
+    return parsed.scheme, parsed.netloc
+
+
+def is_reachable(url):
+    """Whether a URL answers at all (whatever its status), with one fast probe"""
+    try:
+        get_headers(url, timeout=WEBSITE_FAST_PROBE_TIMEOUT, allow_redirects=False, verify=False)
+        return True
+    except requests.exceptions.RequestException:
+        return False
+
+
+def get_headers(url, timed_out_origins=None, **kwargs):
+    """
+    GET a URL (following redirects, as requested), without downloading the final body:
+    the checks only need the status, final URL and redirect history. The response is
+    closed, so its content can't be read.
+
+    With a `timed_out_origins` set, the origins that time out are added to it, and
+    requests to those origins fail right away instead of waiting for the timeout again.
+    Origins are (scheme, netloc): a site may only be served over one of the schemes,
+    and its www and non-www variants may be served by different hosts.
+    """
+    if timed_out_origins is None:
+        timed_out_origins = set()
+    if url_origin(url) in timed_out_origins:
+        raise requests.exceptions.ConnectTimeout(f"{url_origin(url)[1]} already timed out")
+
+    try:
+        response = get_session().get(url, stream=True, **kwargs)
+    except requests.exceptions.Timeout as e:
+        # The timeout may have happened on a redirect target
+        timed_out_origins.add(url_origin(e.request.url if e.request is not None else url))
+        raise
+    content_length = response.headers.get("Content-Length", "")
+    if content_length.isdigit() and int(content_length) <= WEBSITE_BODY_DRAIN_MAX:
+        # Reading it all lets the connection go back to the pool
+        response.content  # noqa: B018
+    response.close()
+    return response
+
+
 def normalize_domain(netloc):
     """Lowercase a netloc and strip the default ports and a leading "www."."""
     netloc = netloc.lower()
@@ -149,7 +297,7 @@ def check_http(base_url, urls_to_test, issues, request_kwargs):
     """
 
     try:
-        http_response = requests.get(urls_to_test["http"], **{**request_kwargs, "verify": False})
+        http_response = get_headers(urls_to_test["http"], **{**request_kwargs, "verify": False})
 
         if http_response.status_code != 200:
             if base_url.startswith("https://"):
@@ -190,7 +338,7 @@ def check_https(base_url, urls_to_test, issues, request_kwargs):
     """
 
     try:
-        https_response = requests.get(urls_to_test["https"], **request_kwargs)
+        https_response = get_headers(urls_to_test["https"], **request_kwargs)
         if https_response.status_code != 200:
             issues[Issues.WEBSITE_DOWN] = f"HTTPS returned status {https_response.status_code}"
         else:
@@ -223,7 +371,7 @@ def check_non_www(base_final_domain, base_url, urls_to_test, issues, request_kwa
         if url_type not in urls_to_test:
             continue
         try:
-            response = requests.get(urls_to_test[url_type], **{**request_kwargs, "verify": False})
+            response = get_headers(urls_to_test[url_type], **{**request_kwargs, "verify": False})
             if response.status_code != 200 and not response.history:
                 if url_type == "http_no_www":
                     issues[Issues.WEBSITE_HTTP_NOWWW] = (
@@ -250,7 +398,7 @@ def check_non_www(base_final_domain, base_url, urls_to_test, issues, request_kwa
                 # verify the base URL has a correct SSL certificate
                 if url_type == "https_no_www" and Issues.WEBSITE_HTTPS_NOWWW not in issues:
                     try:
-                        requests.get(base_url, **{**request_kwargs, "allow_redirects": False})
+                        get_headers(base_url, **{**request_kwargs, "allow_redirects": False})
                     except requests.exceptions.SSLError:
                         issues[Issues.WEBSITE_HTTPS_NOWWW] = (
                             f"SSL certificate error on base URL before redirect: {base_url}"
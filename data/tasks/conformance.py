@@ -39,6 +39,53 @@ class Issues(Enum):
         return self.name
 
 
+# Bit of each issue in compact encodings (e.g. data_checks_log.issues). Stored data depends
+# on this order: new issues must be appended, and removed ones left in place.
+ISSUE_BITS = {
+    name: 1 << position
+    for position, name in enumerate(
+        [
+            "EMAIL_MISSING",
+            "EMAIL_MALFORMED",
+            "WEBSITE_MISSING",
+            "WEBSITE_MALFORMED",
+            "WEBSITE_DECLARED_HTTP",
+            "EMAIL_DOMAIN_MISMATCH",
+            "EMAIL_DOMAIN_GENERIC",
+            "WEBSITE_DOMAIN_EXTENSION",
+            "EMAIL_DOMAIN_EXTENSION",
+            "IN_PROGRESS",
+            "WEBSITE_DOWN",
+            "WEBSITE_SSL",
+            "WEBSITE_DOMAIN_REDIRECT",
+            "WEBSITE_HTTP_REDIRECT",
+            "WEBSITE_HTTPS_NOWWW",
+            "WEBSITE_HTTP_NOWWW",
+            "DNS_DOWN",
+            "DNS_MX_MISSING",
+            "DNS_SPF_MISSING",
+            "DNS_DMARC_MISSING",
+            "DNS_DMARC_WEAK",
+            "DNS_MX_OUTSIDE_EU",
+        ]
+    )
+}
+
+
+def issues_to_bitmask(issue_list):
+    """Encode a list of issues (or issue names) as an integer bitmask.
+    Unknown issue names (e.g. in old stored checks) are ignored."""
+    bitmask = 0
+    for issue in issue_list:
+        bitmask |= ISSUE_BITS.get(str(issue), 0)
+    return bitmask
+
+
+def bitmask_to_issues(bitmask):
+    """Decode a bitmask from issues_to_bitmask into a list of Issues"""
+    return [Issues[name] for name, bit in ISSUE_BITS.items() if bitmask & bit]
+
+
 RcpntRefs = {
     "1.1",
     "1.2",
@@ -78,187 +125,237 @@ WEBSITE_REGEX = re.compile(
 # )
 
 
-def validate_conformance(email, website, bypass_website_regex=False):
-    issues = []
+_GENERIC_EMAIL_DOMAINS = frozenset(GENERIC_EMAIL_DOMAINS)
+_DOMAIN_EXTENSIONS_ALLOWED = frozenset(DOMAIN_EXTENSIONS_ALLOWED)
 
-    email_domain = ""
-    website_domain = ""
-    website_domain_extension = ""
-    email_domain_extension = ""
 
+def _validate_email(email):
+    """Issues bitmask of an email alone, and its domain if it is valid"""
     if len(email) == 0:
-        issues.append(Issues.EMAIL_MISSING)
-    elif not EMAIL_REGEX.match(email):
-        issues.append(Issues.EMAIL_MALFORMED)
-    else:
-        email_domain = email.split("@")[1]
-        email_domain_extension = email_domain.split(".")[-1]
+        return ISSUE_BITS["EMAIL_MISSING"], ""
+    if not EMAIL_REGEX.match(email):
+        return ISSUE_BITS["EMAIL_MALFORMED"], ""
 
+    issues_mask = 0
+    email_domain = email.split("@")[1]
+    if email_domain in _GENERIC_EMAIL_DOMAINS:
+        issues_mask |= ISSUE_BITS["EMAIL_DOMAIN_GENERIC"]
+    if email_domain.split(".")[-1] not in _DOMAIN_EXTENSIONS_ALLOWED:
+        issues_mask |= ISSUE_BITS["EMAIL_DOMAIN_EXTENSION"]
+    return issues_mask, email_domain
+
+
+def _validate_website(website, bypass_website_regex):
+    """Issues bitmask of a website alone, and its domain if it is valid"""
     if len(website) == 0:
-        issues.append(Issues.WEBSITE_MISSING)
-    elif not WEBSITE_REGEX.match(website) and not bypass_website_regex:
-        issues.append(Issues.WEBSITE_MALFORMED)
-    else:
-        website_domain = re.sub(r"^www\.", "", website.split("/")[2])
-        website_domain_extension = website_domain.split(".")[-1]
+        return ISSUE_BITS["WEBSITE_MISSING"], ""
+    if not WEBSITE_REGEX.match(website) and not bypass_website_regex:
+        return ISSUE_BITS["WEBSITE_MALFORMED"], ""
+
+    issues_mask = 0
+    website_domain = re.sub(r"^www\.", "", website.split("/")[2])
+    if website.startswith("http://"):
+        issues_mask |= ISSUE_BITS["WEBSITE_DECLARED_HTTP"]
+    website_domain_extension = website_domain.split(".")[-1]
+    if website_domain_extension and website_domain_extension not in _DOMAIN_EXTENSIONS_ALLOWED:
+        issues_mask |= ISSUE_BITS["WEBSITE_DOMAIN_EXTENSION"]
+    return issues_mask, website_domain
+
+
+def validate_conformance_masks(emails, websites, bypass_website_regex=False):
+    """
+    Batch version of validate_conformance, for the emails and websites of many orgs
+    (the same index in both lists being the same org).
+
+    Returns the issues of each org as a bitmask (see issues_to_bitmask). Each distinct
+    email and website is only parsed once.
+    """
+    validated_emails = {}
+    validated_websites = {}
+    issues_masks = []
+    for email, website in zip(emails, websites, strict=True):
+        if email not in validated_emails:
+            validated_emails[email] = _validate_email(email)
+        if website not in validated_websites:
+            validated_websites[website] = _validate_website(website, bypass_website_regex)
+        email_mask, email_domain = validated_emails[email]
+        website_mask, website_domain = validated_websites[website]
+
+        issues_mask = email_mask | website_mask
+        if email_domain and website_domain and email_domain != website_domain:
+            issues_mask |= ISSUE_BITS["EMAIL_DOMAIN_MISMATCH"]
+        issues_masks.append(issues_mask)
+
+    return issues_masks
 
-        if website.startswith("http://"):
-            issues.append(Issues.WEBSITE_DECLARED_HTTP)
 
-    if len(email_domain) > 0 and len(website_domain) > 0 and email_domain != website_domain:
-        issues.append(Issues.EMAIL_DOMAIN_MISMATCH)
+def validate_conformance(email, website, bypass_website_regex=False):
+    # Issues come out in the order they are checked in, which is the order of ISSUE_BITS
+    return bitmask_to_issues(
+        validate_conformance_masks([email], [website], bypass_website_regex)[0]
+    )
 
-    if email_domain and email_domain in GENERIC_EMAIL_DOMAINS:
-        issues.append(Issues.EMAIL_DOMAIN_GENERIC)
 
-    if website_domain_extension and website_domain_extension not in DOMAIN_EXTENSIONS_ALLOWED:
-        issues.append(Issues.WEBSITE_DOMAIN_EXTENSION)
+# Issues that make an asynchronous check impossible
+DATA_CHECKS_BLOCKING_ISSUES = {
+    "dns": [Issues.EMAIL_MISSING, Issues.EMAIL_MALFORMED],
+    "website": [Issues.WEBSITE_MISSING, Issues.WEBSITE_MALFORMED],
+}
 
-    if email_domain_extension and email_domain_extension not in DOMAIN_EXTENSIONS_ALLOWED:
-        issues.append(Issues.EMAIL_DOMAIN_EXTENSION)
 
-    # print("%s - %s : %s" % (email, website, ", ".join(str(x) for x in issues)))
+def data_checks_blocking_issue(check_type, issues_mask):
+    """The first issue in a bitmask of conformance issues that prevents running a check,
+    or None if the check can be run"""
+    for issue in DATA_CHECKS_BLOCKING_ISSUES[check_type]:
+        if issues_mask & ISSUE_BITS[issue.name]:
+            return issue
+    return None
 
-    return issues
+
+def data_checks_doable_mask(issues_mask):
+    """The asynchronous checks that can be run given a bitmask of conformance issues"""
+    return {
+        check_type
+        for check_type in DATA_CHECKS_BLOCKING_ISSUES
+        if data_checks_blocking_issue(check_type, issues_mask) is None
+    }
 
 
 def data_checks_doable(conformance_issues):
-    needed = set()
-
-    if (
-        len(
-            {
-                Issues.EMAIL_MISSING.name,
-                Issues.EMAIL_MALFORMED.name,
-            }.intersection([str(x) for x in conformance_issues])
-        )
-        == 0
-    ):
-        needed.add("dns")
-
-    if (
-        len(
-            {
-                Issues.WEBSITE_MISSING.name,
-                Issues.WEBSITE_MALFORMED.name,
-            }.intersection([str(x) for x in conformance_issues])
-        )
-        == 0
-    ):
-        needed.add("website")
-
-    return needed
+    return data_checks_doable_mask(issues_to_bitmask(conformance_issues))
+
+
+# Bit of each RCPNT ref (criteria and groups) in conformance bitmasks
+RCPNT_REF_BITS = {ref: 1 << position for position, ref in enumerate(sorted(RcpntRefs))}
+
+
+def refs_to_bitmask(refs):
+    """Encode a set of RCPNT refs as an integer bitmask"""
+    bitmask = 0
+    for ref in refs:
+        bitmask |= RCPNT_REF_BITS[ref]
+    return bitmask
+
+
+def bitmask_to_refs(bitmask):
+    """Decode a bitmask from refs_to_bitmask into a set of RCPNT refs"""
+    return {ref for ref, bit in RCPNT_REF_BITS.items() if bitmask & bit}
+
+
+# List of groups of criteria
+RCPNT_GROUPS = {
+    "1.a": {"1.1", "1.2", "1.3", "1.4", "1.5", "1.6"},
+    "1.aa": {"1.1", "1.2", "1.3", "1.4", "1.5", "1.6", "1.7", "1.8"},
+    "a": {"1.1", "1.2", "1.3", "1.4", "1.5", "2.1", "2.2", "2.3", "2.4", "2.5", "2.8"},
+    "aa": {
+        "1.1",
+        "1.2",
+        "1.3",
+        "1.4",
+        "1.5",
+        "1.6",
+        "1.7",
+        "1.8",
+        "2.1",
+        "2.2",
+        "2.3",
+        "2.4",
+        "2.5",
+        "2.6",
+        "2.7",
+        "2.8",
+    },
+    "2.a": {"2.1", "2.2", "2.3", "2.4", "2.5", "2.8"},
+    "2.aa": {"2.1", "2.2", "2.3", "2.4", "2.5", "2.6", "2.7", "2.8"},
+}
 
+# Without a usable website (and no email domain extension issue), there is no need for
+# 2.3 in the email groups
+RCPNT_GROUPS_WITHOUT_WEBSITE = {
+    **RCPNT_GROUPS,
+    "2.a": {"2.1", "2.2", "2.4", "2.5", "2.8"},
+    "2.aa": {"2.1", "2.2", "2.4", "2.5", "2.6", "2.7", "2.8"},
+}
 
-def get_rcpnt_conformance(issue_list):
-    """Transform a list of issues into RCPNT conformance items"""
+# List of criterion that can't be valid if issues are absent (dependencies)
+RCPNT_BLOCKING_ISSUES = {
+    # Declarative issues from DILA data
+    Issues.EMAIL_MISSING: {"2.1", "2.2", "2.3", "2.4", "2.5", "2.6", "2.7", "2.8"},
+    Issues.EMAIL_MALFORMED: {"2.1", "2.2", "2.3", "2.4", "2.5", "2.6", "2.7", "2.8"},
+    Issues.WEBSITE_MISSING: {"1.1", "1.2", "1.3", "1.4", "1.5", "1.6", "1.7", "1.8", "2.3"},
+    Issues.WEBSITE_MALFORMED: {"1.1", "1.2", "1.3", "1.4", "1.5", "1.6", "1.7", "1.8", "2.3"},
+    Issues.WEBSITE_DECLARED_HTTP: {"1.8"},
+    Issues.EMAIL_DOMAIN_MISMATCH: {"2.3"},
+    Issues.EMAIL_DOMAIN_GENERIC: {"2.2", "2.3"},
+    Issues.WEBSITE_DOMAIN_EXTENSION: {"1.2"},
+    Issues.EMAIL_DOMAIN_EXTENSION: {"2.3"},
+    # Issues that are tested in check_website
+    Issues.WEBSITE_DOWN: {"1.3", "1.4", "1.5", "1.6", "1.7"},
+    Issues.WEBSITE_SSL: {"1.5"},
+    Issues.WEBSITE_DOMAIN_REDIRECT: {"1.6"},
+    Issues.WEBSITE_HTTP_REDIRECT: {"1.4", "1.7"},
+    Issues.WEBSITE_HTTPS_NOWWW: {"1.7"},
+    Issues.WEBSITE_HTTP_NOWWW: {"1.7"},
+    # Issues that are tested in check_dns
+    Issues.DNS_DOWN: {"2.4", "2.5", "2.6", "2.7", "2.8"},
+    Issues.DNS_MX_MISSING: {"2.4", "2.5", "2.6", "2.7", "2.8"},
+    Issues.DNS_SPF_MISSING: {"2.5"},
+    Issues.DNS_DMARC_MISSING: {"2.6", "2.7"},
+    Issues.DNS_DMARC_WEAK: {"2.7"},
+    Issues.DNS_MX_OUTSIDE_EU: {"2.8"},
+}
 
-    issues = {str(x) for x in issue_list}
-
-    # List of groups of criteria
-    groups = {
-        "1.a": {"1.1", "1.2", "1.3", "1.4", "1.5", "1.6"},
-        "1.aa": {"1.1", "1.2", "1.3", "1.4", "1.5", "1.6", "1.7", "1.8"},
-        "a": {"1.1", "1.2", "1.3", "1.4", "1.5", "2.1", "2.2", "2.3", "2.4", "2.5", "2.8"},
-        "aa": {
-            "1.1",
-            "1.2",
-            "1.3",
-            "1.4",
-            "1.5",
-            "1.6",
-            "1.7",
-            "1.8",
-            "2.1",
-            "2.2",
-            "2.3",
-            "2.4",
-            "2.5",
-            "2.6",
-            "2.7",
-            "2.8",
-        },
-    }
+# The rules above, compiled to bitmasks (issues bits from ISSUE_BITS, refs bits from
+# RCPNT_REF_BITS) once and for all
+_RCPNT_BLOCKING_MASKS = [
+    (ISSUE_BITS[issue.name], refs_to_bitmask(criteria))
+    for issue, criteria in RCPNT_BLOCKING_ISSUES.items()
+]
+_RCPNT_GROUP_MASKS = [
+    (RCPNT_REF_BITS[group], refs_to_bitmask(criteria)) for group, criteria in RCPNT_GROUPS.items()
+]
+_RCPNT_GROUP_MASKS_WITHOUT_WEBSITE = [
+    (RCPNT_REF_BITS[group], refs_to_bitmask(criteria))
+    for group, criteria in RCPNT_GROUPS_WITHOUT_WEBSITE.items()
+]
+_RCPNT_AA_MASK = refs_to_bitmask(RCPNT_GROUPS["aa"])
+_WEBSITE_UNUSABLE_MASK = issues_to_bitmask(
+    [Issues.WEBSITE_MISSING, Issues.WEBSITE_MALFORMED, Issues.WEBSITE_DOMAIN_EXTENSION]
+)
+_EMAIL_DOMAIN_EXTENSION_MASK = issues_to_bitmask([Issues.EMAIL_DOMAIN_EXTENSION])
 
-    if (
-        str(Issues.WEBSITE_MISSING) in issues
-        or str(Issues.WEBSITE_MALFORMED) in issues
-        or str(Issues.WEBSITE_DOMAIN_EXTENSION) in issues
-    ) and (str(Issues.EMAIL_DOMAIN_EXTENSION) not in issues):
-        # No need for 2.3 in this case
-        groups.update(
-            {
-                "2.a": {"2.1", "2.2", "2.4", "2.5", "2.8"},
-                "2.aa": {"2.1", "2.2", "2.4", "2.5", "2.6", "2.7", "2.8"},
-            }
-        )
-    else:
-        groups.update(
-            {
-                "2.a": {"2.1", "2.2", "2.3", "2.4", "2.5", "2.8"},
-                "2.aa": {"2.1", "2.2", "2.3", "2.4", "2.5", "2.6", "2.7", "2.8"},
-            }
-        )
-
-    # List of criterion that can't be valid if issues are absent (dependencies)
-    blocking_issues = {
-        # Declarative issues from DILA data
-        str(Issues.EMAIL_MISSING): {"2.1", "2.2", "2.3", "2.4", "2.5", "2.6", "2.7", "2.8"},
-        str(Issues.EMAIL_MALFORMED): {"2.1", "2.2", "2.3", "2.4", "2.5", "2.6", "2.7", "2.8"},
-        str(Issues.WEBSITE_MISSING): {
-            "1.1",
-            "1.2",
-            "1.3",
-            "1.4",
-            "1.5",
-            "1.6",
-            "1.7",
-            "1.8",
-            "2.3",
-        },
-        str(Issues.WEBSITE_MALFORMED): {
-            "1.1",
-            "1.2",
-            "1.3",
-            "1.4",
-            "1.5",
-            "1.6",
-            "1.7",
-            "1.8",
-            "2.3",
-        },
-        str(Issues.WEBSITE_DECLARED_HTTP): {"1.8"},
-        str(Issues.EMAIL_DOMAIN_MISMATCH): {"2.3"},
-        str(Issues.EMAIL_DOMAIN_GENERIC): {"2.2", "2.3"},
-        str(Issues.WEBSITE_DOMAIN_EXTENSION): {"1.2"},
-        str(Issues.EMAIL_DOMAIN_EXTENSION): {"2.3"},
-        # Issues that are tested in check_website
-        str(Issues.WEBSITE_DOWN): {"1.3", "1.4", "1.5", "1.6", "1.7"},
-        str(Issues.WEBSITE_SSL): {"1.5"},
-        str(Issues.WEBSITE_DOMAIN_REDIRECT): {"1.6"},
-        str(Issues.WEBSITE_HTTP_REDIRECT): {"1.4", "1.7"},
-        str(Issues.WEBSITE_HTTPS_NOWWW): {"1.7"},
-        str(Issues.WEBSITE_HTTP_NOWWW): {"1.7"},
-        # Issues that are tested in check_dns
-        str(Issues.DNS_DOWN): {"2.4", "2.5", "2.6", "2.7", "2.8"},
-        str(Issues.DNS_MX_MISSING): {"2.4", "2.5", "2.6", "2.7", "2.8"},
-        str(Issues.DNS_SPF_MISSING): {"2.5"},
-        str(Issues.DNS_DMARC_MISSING): {"2.6", "2.7"},
-        str(Issues.DNS_DMARC_WEAK): {"2.7"},
-        str(Issues.DNS_MX_OUTSIDE_EU): {"2.8"},
-    }
 
-    # By default we're AA
-    conformance_items = set(groups["aa"])
+def get_rcpnt_conformance_mask(issues_mask):
+    """Transform a bitmask of issues into a bitmask of RCPNT conformance items"""
 
-    # Remove criteria that can't be valid if issues are absent
-    for issue, criteria in blocking_issues.items():
-        if issue in issues:
-            conformance_items.difference_update(criteria)
+    # By default we're AA. Remove criteria that can't be valid if issues are absent
+    conformance_mask = _RCPNT_AA_MASK
+    for issue_bit, criteria_mask in _RCPNT_BLOCKING_MASKS:
+        if issues_mask & issue_bit:
+            conformance_mask &= ~criteria_mask
 
     # Add group if all criteria are present
-    for group, criteria in groups.items():
-        if criteria.issubset(conformance_items):
-            conformance_items.add(group)
+    if issues_mask & _WEBSITE_UNUSABLE_MASK and not issues_mask & _EMAIL_DOMAIN_EXTENSION_MASK:
+        group_masks = _RCPNT_GROUP_MASKS_WITHOUT_WEBSITE
+    else:
+        group_masks = _RCPNT_GROUP_MASKS
+    for group_bit, criteria_mask in group_masks:
+        if conformance_mask & criteria_mask == criteria_mask:
+            conformance_mask |= group_bit
+
+    return conformance_mask
+
 
-    return conformance_items
+def get_rcpnt_conformance_masks(issues_masks):
+    """Transform bitmasks of issues into bitmasks of RCPNT conformance items, in the same
+    order. Each distinct issues bitmask (there are few of them) is only evaluated once."""
+    conformance_masks = {}
+    for issues_mask in issues_masks:
+        if issues_mask not in conformance_masks:
+            conformance_masks[issues_mask] = get_rcpnt_conformance_mask(issues_mask)
+    return [conformance_masks[issues_mask] for issues_mask in issues_masks]
+
+
+def get_rcpnt_conformance(issue_list):
+    """Transform a list of issues into RCPNT conformance items"""
+    return bitmask_to_refs(get_rcpnt_conformance_mask(issues_to_bitmask(issue_list)))
@@ -1,14 +1,22 @@
+import atexit
 import datetime
+import gzip
+import hashlib
 import json
+import logging
 import os
 import random
-from collections import defaultdict
+import threading
+import time
 from typing import Dict, Optional
 
+import pandas as pd
 from psycopg2 import connect as pg_connect
-from psycopg2.extras import DictCursor
+from psycopg2.extras import DictCursor, execute_values
 
-from .conformance import Issues, RcpntRefs, data_checks_doable
+from .conformance import Issues, RcpntRefs, data_checks_doable, issues_to_bitmask
+
+logger = logging.getLogger(__name__)
 
 
 def get_db():
@@ -30,13 +38,76 @@ def init_db():
                     issues VARCHAR(64)[] NOT NULL,
                     details TEXT[] NOT NULL,
                     metadata JSONB NOT NULL,
+                    content_hash TEXT,
+                    dt TIMESTAMP WITH TIME ZONE NOT NULL,
+                    PRIMARY KEY (siret, type)
+                );
+                -- When each check was last run, even if its result didn't change.
+                -- Kept apart so that this nightly touch only rewrites narrow rows
+                -- (as HOT updates, dt not being indexed).
+                CREATE TABLE IF NOT EXISTS data_checks_verified (
+                    siret VARCHAR(14) NOT NULL,
+                    type VARCHAR(16) NOT NULL,
                     dt TIMESTAMP WITH TIME ZONE NOT NULL,
                     PRIMARY KEY (siret, type)
+                ) WITH (fillfactor = 70);
+                CREATE TABLE IF NOT EXISTS data_rcpnt_states (
+                    siret VARCHAR(14) PRIMARY KEY,
+                    state JSONB NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS data_sirene_extract (
+                    siren VARCHAR(9) PRIMARY KEY,
+                    row JSONB,
+                    stock_version TEXT NOT NULL,
+                    dt TIMESTAMP WITH TIME ZONE NOT NULL
+                );
+                -- Output of the last run of each sync stage, reused while its inputs
+                -- (hashed into input_hash) are unchanged
+                CREATE TABLE IF NOT EXISTS data_sync_checkpoints (
+                    stage VARCHAR(64) PRIMARY KEY,
+                    input_hash TEXT NOT NULL,
+                    output BYTEA,
+                    dt TIMESTAMP WITH TIME ZONE NOT NULL
                 );
+                -- Website hosts that timed out, not fully checked again until next_check_dt
+                CREATE TABLE IF NOT EXISTS data_dead_hosts (
+                    host VARCHAR(255) PRIMARY KEY,
+                    failures INTEGER NOT NULL,
+                    first_failure_dt TIMESTAMP WITH TIME ZONE NOT NULL,
+                    next_check_dt TIMESTAMP WITH TIME ZONE NOT NULL
+                );
+                -- Every check result, for trends. Issues are encoded with
+                -- conformance.issues_to_bitmask.
+                CREATE TABLE IF NOT EXISTS data_checks_log (
+                    siret VARCHAR(14) NOT NULL,
+                    type VARCHAR(16) NOT NULL,
+                    issues INTEGER NOT NULL,
+                    dt TIMESTAMP WITH TIME ZONE NOT NULL
+                ) PARTITION BY RANGE (dt);
+                CREATE INDEX IF NOT EXISTS idx_data_checks_log_siret
+                ON data_checks_log (siret, dt);
             """)
+            now = datetime.datetime.now(datetime.timezone.utc)
+            create_data_checks_log_partitions(cur, [now, month_start(now, 1)])
             db.commit()
 
 
+# Metadata lists built from sets, whose order can vary between processes. Other lists
+# (redirect chains, MX by priority...) are ordered and compared as is.
+UNORDERED_METADATA_KEYS = ("mx_countries", "mx_ips")
+
+
+def get_check_content_hash(issue_keys: list, issue_details: list, metadata: dict) -> str:
+    """Hash the result of a check, to only rewrite it when it changed"""
+    metadata = {
+        key: sorted(value) if key in UNORDERED_METADATA_KEYS and value else value
+        for key, value in metadata.items()
+    }
+    return hashlib.sha256(
+        json.dumps([issue_keys, issue_details, metadata], sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
 def upsert_issues(
     siret: str, check_type: str, issues: Dict[Issues, str], metadata: Dict[str, str]
 ):
@@ -56,53 +127,200 @@ def upsert_issues(
         issue_keys.append(key.name)  # Use .name to get the string value of the enum
         issue_details.append(detail)
 
-    # Store in database
+    metadata_json = json.dumps(metadata or {}, sort_keys=True)
+    content_hash = get_check_content_hash(issue_keys, issue_details, metadata or {})
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    # Store in database. The data_checks row is only rewritten when the result of the
+    # check changed (its dt is then when it last changed), but the check is always
+    # recorded as verified now.
     with get_db() as db:
         with db.cursor() as cur:
             cur.execute(
                 """
-                INSERT INTO data_checks (siret, type, issues, details, metadata, dt)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                ON CONFLICT (siret, type) DO UPDATE SET
-                    issues = EXCLUDED.issues,
-                    details = EXCLUDED.details,
-                    metadata = EXCLUDED.metadata,
-                    dt = EXCLUDED.dt
+                WITH upserted AS (
+                    INSERT INTO data_checks (siret, type, issues, details, metadata, content_hash, dt)
+                    VALUES (%(siret)s, %(type)s, %(issues)s, %(details)s, %(metadata)s,
+                            %(content_hash)s, %(dt)s)
+                    ON CONFLICT (siret, type) DO UPDATE SET
+                        issues = EXCLUDED.issues,
+                        details = EXCLUDED.details,
+                        metadata = EXCLUDED.metadata,
+                        content_hash = EXCLUDED.content_hash,
+                        dt = EXCLUDED.dt
+                    WHERE data_checks.content_hash IS DISTINCT FROM EXCLUDED.content_hash
+                )
+                INSERT INTO data_checks_verified (siret, type, dt)
+                VALUES (%(siret)s, %(type)s, %(dt)s)
+                ON CONFLICT (siret, type) DO UPDATE SET dt = EXCLUDED.dt
             """,
-                (
-                    siret,
-                    check_type,
-                    issue_keys,
-                    issue_details,
-                    json.dumps(metadata or {}),
-                    datetime.datetime.now(datetime.timezone.utc),
-                ),
+                {
+                    "siret": siret,
+                    "type": check_type,
+                    "issues": issue_keys,
+                    "details": issue_details,
+                    "metadata": metadata_json,
+                    "content_hash": content_hash,
+                    "dt": now,
+                },
             )
         db.commit()
 
+    log_data_check(siret, check_type, issue_keys, now)
+
 
-def get_all_data_checks():
-    """Get issues from checks for all SIRETs."""
+DATA_CHECKS_LOG_RETENTION_MONTHS = int(os.getenv("DATA_CHECKS_LOG_RETENTION_MONTHS", "13"))
+DATA_CHECKS_LOG_BATCH_SIZE = 500
+DATA_CHECKS_LOG_MAX_DELAY = 60  # in seconds
+DATA_CHECKS_LOG_MAX_BUFFER = 50_000
+
+# Check results waiting to be written to data_checks_log, by this worker process
+_data_checks_log_buffer = {"rows": [], "flushed_at": time.monotonic()}
+_data_checks_log_lock = threading.Lock()
+_data_checks_log_partitions = set()
+
+
+def month_start(dt: datetime.datetime, months: int = 0):
+    """The start (in UTC) of the month of a datetime, shifted by a number of months"""
+    month_index = dt.year * 12 + dt.month - 1 + months
+    return datetime.datetime(
+        month_index // 12, month_index % 12 + 1, 1, tzinfo=datetime.timezone.utc
+    )
+
+
+def create_data_checks_log_partitions(cur, dts):
+    """Create the monthly partitions of data_checks_log covering some datetimes"""
+    for start in {month_start(dt) for dt in dts}:
+        partition_name = f"data_checks_log_{start:%Y_%m}"
+        if partition_name in _data_checks_log_partitions:
+            continue
+        cur.execute(
+            f"CREATE TABLE IF NOT EXISTS {partition_name} PARTITION OF data_checks_log "
+            "FOR VALUES FROM (%s) TO (%s);",
+            (start, month_start(start, 1)),
+        )
+        _data_checks_log_partitions.add(partition_name)
+
+
+def log_data_check(siret: str, check_type: str, issue_keys, dt: datetime.datetime):
+    """
+    Append a check result to data_checks_log. Results are buffered and written in
+    batches, at the latest DATA_CHECKS_LOG_MAX_DELAY seconds after the last write.
+    """
+    with _data_checks_log_lock:
+        rows = _data_checks_log_buffer["rows"]
+        rows.append((siret, check_type, issues_to_bitmask(issue_keys), dt))
+        flush = (
+            len(rows) >= DATA_CHECKS_LOG_BATCH_SIZE
+            or time.monotonic() - _data_checks_log_buffer["flushed_at"]
+            >= DATA_CHECKS_LOG_MAX_DELAY
+        )
+    if flush:
+        flush_data_checks_log()
+
+
+# Flushed when the worker shuts down (see broker.py), and when other processes exit
+@atexit.register
+def flush_data_checks_log():
+    """
+    Write the buffered check results to data_checks_log. This never raises: the results
+    were already stored in data_checks, so a failure to log them must not fail the
+    check. They are kept in the buffer for the next flush instead (up to
+    DATA_CHECKS_LOG_MAX_BUFFER rows).
+    """
+    with _data_checks_log_lock:
+        rows = _data_checks_log_buffer["rows"]
+        _data_checks_log_buffer["rows"] = []
+        _data_checks_log_buffer["flushed_at"] = time.monotonic()
+    if not rows or not os.getenv("DATABASE_URL"):
+        return
+
+    try:
+        with get_db() as db:
+            with db.cursor() as cur:
+                create_data_checks_log_partitions(cur, [row[3] for row in rows])
+                execute_values(
+                    cur,
+                    "INSERT INTO data_checks_log (siret, type, issues, dt) VALUES %s",
+                    rows,
+                    page_size=DATA_CHECKS_LOG_BATCH_SIZE,
+                )
+            db.commit()
+    except Exception:
+        logger.exception("Could not write %d rows to data_checks_log", len(rows))
+        with _data_checks_log_lock:
+            # The partitions created in the failed transaction were rolled back
+            _data_checks_log_partitions.clear()
+            rows = rows + _data_checks_log_buffer["rows"]
+            if len(rows) > DATA_CHECKS_LOG_MAX_BUFFER:
+                logger.warning(
+                    "Dropping the %d oldest rows of data_checks_log",
+                    len(rows) - DATA_CHECKS_LOG_MAX_BUFFER,
+                )
+                rows = rows[-DATA_CHECKS_LOG_MAX_BUFFER:]
+            _data_checks_log_buffer["rows"] = rows
 
-    all_data_checks = defaultdict(list)
+
+def prune_data_checks_log(retention_months: int = DATA_CHECKS_LOG_RETENTION_MONTHS):
+    """Drop the monthly partitions of data_checks_log older than the retention period"""
+    oldest_month = month_start(datetime.datetime.now(datetime.timezone.utc), -retention_months)
+    oldest_partition_name = f"data_checks_log_{oldest_month:%Y_%m}"
 
     with get_db() as db:
         with db.cursor() as cur:
-            cur.execute("SELECT siret, type, issues, details, metadata, dt FROM data_checks")
-            for check in cur.fetchall():
-                all_data_checks[check["siret"]].append(check)
+            cur.execute(
+                "SELECT inhrelid::regclass::text FROM pg_inherits "
+                "WHERE inhparent = 'data_checks_log'::regclass;"
+            )
+            for (partition_name,) in cur.fetchall():
+                # Partition names sort like their months
+                if partition_name < oldest_partition_name:
+                    cur.execute(f"DROP TABLE {partition_name};")
+                    _data_checks_log_partitions.discard(partition_name)
+                    logger.info(f"Dropped {partition_name}")
+        db.commit()
+
 
-    return all_data_checks
+def iter_data_checks_by_siret():
+    """
+    Stream the checks of every SIRET, aggregated in one row per SIRET and in SIRET order
+    (the order of Python strings): the types of checks done, the issues found as a dict of
+    issue to details, the metadata of the website and dns checks, and the oldest check date.
+    """
+    with get_db() as db:
+        with db.cursor(name="data_checks_by_siret") as cur:
+            cur.itersize = 10000
+            cur.execute("""
+                SELECT c.siret,
+                       array_agg(DISTINCT c.type) AS types,
+                       COALESCE(
+                           json_object_agg(i.issue, i.detail ORDER BY c.type, i.position)
+                               FILTER (WHERE i.issue IS NOT NULL),
+                           '{}'
+                       ) AS issues,
+                       (array_agg(c.metadata) FILTER (WHERE c.type = 'website'))[1]
+                           AS website_metadata,
+                       (array_agg(c.metadata) FILTER (WHERE c.type = 'dns'))[1] AS email_metadata,
+                       min(COALESCE(v.dt, c.dt)) AS dt
+                FROM data_checks c
+                LEFT JOIN data_checks_verified v ON v.siret = c.siret AND v.type = c.type
+                LEFT JOIN LATERAL unnest(c.issues, c.details) WITH ORDINALITY
+                    AS i(issue, detail, position) ON TRUE
+                GROUP BY c.siret
+                ORDER BY c.siret COLLATE "C"
+            """)
+            yield from cur
 
 
-def get_data_checks_by_siret(all_data_checks, conformance_issues, siret: str):
-    """Get issues and metadata from checks for a given SIRET.
+def get_org_data_checks(siret_checks, conformance_issues):
+    """Get issues and metadata from the aggregated checks of a SIRET (from
+    iter_data_checks_by_siret, or None if it has none).
     We must have at least one row of each type of check."""
 
     min_dt = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
 
     expected_types = data_checks_doable(conformance_issues)
-    checked_types = {check["type"] for check in all_data_checks.get(siret, [])}
+    checked_types = set(siret_checks["types"]) if siret_checks else set()
     if not expected_types.issubset(checked_types):
         return (
             {
@@ -114,19 +332,143 @@ def get_data_checks_by_siret(all_data_checks, conformance_issues, siret: str):
             min_dt,
         )
 
-    email_metadata = {}
-    website_metadata = {}
-    issues = {}
-    for check in all_data_checks[siret]:
-        for idx, issue in enumerate(check["issues"]):
-            issues[issue] = check["details"][idx]
-        if check["type"] == "dns":
-            email_metadata = check.get("metadata", {})
-        elif check["type"] == "website":
-            website_metadata = check.get("metadata", {})
-        min_dt = min(min_dt, check["dt"])
+    if not siret_checks:
+        return {}, {}, {}, min_dt
+
+    return (
+        siret_checks["issues"],
+        siret_checks["website_metadata"] or {},
+        siret_checks["email_metadata"] or {},
+        min(min_dt, siret_checks["dt"]).replace(microsecond=0),
+    )
+
+
+def get_sirene_extract(sirens, stock_version: str):
+    """
+    Get the persisted SIRENE rows of the given SIRENs, as extracted from a given
+    version of the SIRENE stock file.
+
+    Returns a dict of SIREN to row, or to None when that stock had no matching siège
+    row. SIRENs absent from the dict were never looked up in that stock.
+    """
+    if not os.getenv("DATABASE_URL"):
+        return {}
+
+    with get_db() as db:
+        with db.cursor() as cur:
+            cur.execute(
+                "SELECT siren, row FROM data_sirene_extract "
+                "WHERE stock_version = %s AND siren = ANY(%s)",
+                (stock_version, list(sirens)),
+            )
+            return {row["siren"]: row["row"] for row in cur.fetchall()}
+
+
+def get_sirene_extract_version():
+    """Get the version of the SIRENE stock file of the last persisted extract, if any"""
+    if not os.getenv("DATABASE_URL"):
+        return None
+
+    with get_db() as db:
+        with db.cursor() as cur:
+            cur.execute("SELECT stock_version FROM data_sirene_extract ORDER BY dt DESC LIMIT 1")
+            row = cur.fetchone()
+            return row["stock_version"] if row else None
+
+
+def save_sirene_extract(sirens, rows: list, stock_version: str):
+    """
+    Persist the SIRENE rows extracted from a version of the SIRENE stock file.
+    SIRENs that were looked up but not found are stored with a NULL row.
+    """
+    if not os.getenv("DATABASE_URL"):
+        return
+
+    rows_by_siren = {row["siren"]: row for row in rows}
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    with get_db() as db:
+        with db.cursor() as cur:
+            execute_values(
+                cur,
+                """
+                INSERT INTO data_sirene_extract (siren, row, stock_version, dt)
+                VALUES %s
+                ON CONFLICT (siren) DO UPDATE SET
+                    row = EXCLUDED.row,
+                    stock_version = EXCLUDED.stock_version,
+                    dt = EXCLUDED.dt
+                """,
+                [
+                    (
+                        siren,
+                        json.dumps(rows_by_siren[siren]) if siren in rows_by_siren else None,
+                        stock_version,
+                        now,
+                    )
+                    for siren in sirens
+                ],
+                page_size=1000,
+            )
+        db.commit()
+
+
+def get_sync_checkpoint(stage: str, input_hash: str):
+    """
+    Get the checkpoint of a sync stage if it was saved for the same inputs.
+    Returns a (found, output) tuple, the output being decoded from gzipped JSON.
+    """
+    if not os.getenv("DATABASE_URL"):
+        return False, None
+
+    with get_db() as db:
+        with db.cursor() as cur:
+            cur.execute(
+                "SELECT output FROM data_sync_checkpoints WHERE stage = %s AND input_hash = %s",
+                (stage, input_hash),
+            )
+            row = cur.fetchone()
+    if row is None:
+        return False, None
+    if row["output"] is None:
+        return True, None
+    return True, json.loads(gzip.decompress(row["output"]))
+
+
+def save_sync_checkpoint(stage: str, input_hash: str, output=None):
+    """Persist the output of a sync stage, replacing the one of its previous inputs."""
+    if not os.getenv("DATABASE_URL"):
+        return
+
+    data = None
+    if output is not None:
+        data = gzip.compress(json.dumps(output, ensure_ascii=False).encode("utf-8"), 6)
+
+    with get_db() as db:
+        with db.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO data_sync_checkpoints (stage, input_hash, output, dt)
+                VALUES (%s, %s, %s, NOW())
+                ON CONFLICT (stage) DO UPDATE SET
+                    input_hash = EXCLUDED.input_hash,
+                    output = EXCLUDED.output,
+                    dt = EXCLUDED.dt
+                """,
+                (stage, input_hash, data),
+            )
+        db.commit()
+
 
-    return issues, website_metadata, email_metadata, min_dt.replace(microsecond=0)
+def get_data_check(siret: str, check_type: str):
+    """Get the last stored result of a check of a SIRET, if any."""
+    with get_db() as db:
+        with db.cursor() as cur:
+            cur.execute(
+                "SELECT issues, details, metadata FROM data_checks WHERE siret = %s AND type = %s",
+                (siret, check_type),
+            )
+            return cur.fetchone()
 
 
 def find_org_by_siret(siret: str):
@@ -138,197 +480,667 @@ def find_org_by_siret(siret: str):
             return cur.fetchone()
 
 
-def list_all_orgs(type_filter: Optional[str] = None):
-    """List all organizations."""
+DEAD_HOST_RECHECK_DAYS = 1
+DEAD_HOST_RECHECK_MAX_DAYS = 32
+
+
+def get_dead_host(host: str):
+    """Get the dead host entry of a website host, if it timed out on its last check."""
     with get_db() as db:
         with db.cursor() as cur:
-            if type_filter:
-                cur.execute("SELECT * FROM st_organizations WHERE type = %s", (type_filter,))
-            else:
-                cur.execute("SELECT * FROM st_organizations")
-            return cur.fetchall()
+            cur.execute("SELECT * FROM data_dead_hosts WHERE host = %s", (host,))
+            return cur.fetchone()
 
 
-def historize_table(table_name: str):
+def record_dead_host(host: str):
     """
-    Appends the current data from a table to its corresponding history table,
-    adding `history_date` (DATE) and `history_month` (VARCHAR(7)) columns
-    with the current date and month. Creates the history table (schema only)
-    if it doesn't exist.
-
-    Args:
-        table_name: The name of the table to historize.
+    Record that a website host timed out. It won't be fully checked again for
+    DEAD_HOST_RECHECK_DAYS, an interval that doubles on each consecutive failure (up
+    to DEAD_HOST_RECHECK_MAX_DAYS).
     """
-    history_table_name = f"{table_name}_history"
-
     with get_db() as db:
         with db.cursor() as cur:
-            # Check if history table exists
             cur.execute(
-                "SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = %s);",
-                (history_table_name,),
+                """
+                INSERT INTO data_dead_hosts (host, failures, first_failure_dt, next_check_dt)
+                VALUES (%(host)s, 1, NOW(), NOW() + %(days)s * INTERVAL '1 day')
+                ON CONFLICT (host) DO UPDATE SET
+                    failures = data_dead_hosts.failures + 1,
+                    next_check_dt = NOW() + LEAST(
+                        %(days)s * POWER(2, data_dead_hosts.failures), %(max_days)s
+                    ) * INTERVAL '1 day'
+            """,
+                {
+                    "host": host,
+                    "days": DEAD_HOST_RECHECK_DAYS,
+                    "max_days": DEAD_HOST_RECHECK_MAX_DAYS,
+                },
             )
-            table_exists = cur.fetchone()[0]
+        db.commit()
 
-            if not table_exists:
-                # Create the history table by copying schema ONLY from the original
-                cur.execute(
-                    f"CREATE TABLE {history_table_name} AS TABLE {table_name} WITH NO DATA;"
-                )
-                # Add the history columns
-                cur.execute(f"ALTER TABLE {history_table_name} ADD COLUMN history_date DATE;")
+
+def clear_dead_host(host: str):
+    """Forget a website host that answered again."""
+    with get_db() as db:
+        with db.cursor() as cur:
+            cur.execute("DELETE FROM data_dead_hosts WHERE host = %s", (host,))
+        db.commit()
+
+
+def list_all_orgs(type_filter: Optional[str] = None, columns: Optional[list[str]] = None):
+    """List all organizations, with all their columns or only the given ones."""
+    column_list = ", ".join(f'"{column}"' for column in columns) if columns else "*"
+    with get_db() as db:
+        with db.cursor() as cur:
+            if type_filter:
                 cur.execute(
-                    f"ALTER TABLE {history_table_name} ADD COLUMN history_month VARCHAR(7);"
+                    f"SELECT {column_list} FROM st_organizations WHERE type = %s",  # noqa: S608
+                    (type_filter,),
                 )
-                # No need to populate history columns here, the INSERT below handles it.
+            else:
+                cur.execute(f"SELECT {column_list} FROM st_organizations")  # noqa: S608
+            return cur.fetchall()
 
-            # Get column names (and types, to reconcile drift below) from the original
-            # table. This needs to be done *after* potential table creation.
+
+SNAPSHOT_HISTORY_COLUMNS = {"history_date": "DATE", "history_month": "VARCHAR(7)"}
+DELTA_HISTORY_COLUMNS = {"row_hash": "TEXT", "valid_from": "VARCHAR(7)", "valid_to": "VARCHAR(7)"}
+
+
+def get_column_definitions(cur, table_name: str) -> list[tuple[str, str]]:
+    """Names and types of the columns of a table, in order"""
+    cur.execute(
+        """
+        SELECT a.attname AS column_name, format_type(a.atttypid, a.atttypmod) AS column_type
+        FROM pg_attribute a
+        WHERE a.attrelid = %s::regclass
+          AND a.attnum > 0
+          AND NOT a.attisdropped
+        ORDER BY a.attnum;
+    """,
+        (table_name,),
+    )
+    return [(row[0], row[1]) for row in cur.fetchall()]
+
+
+def create_partitioned_table(cur, table_name: str, columns: list[tuple[str, str]], key: str):
+    """Create a table partitioned by LIST on `key`, with the given columns"""
+    column_definitions = ", ".join(f'"{name}" {column_type}' for name, column_type in columns)
+    cur.execute(f"CREATE TABLE {table_name} ({column_definitions}) PARTITION BY LIST ({key});")
+
+
+def prepare_history_table(
+    cur,
+    table_name: str,
+    history_table_name: str,
+    history_columns: dict[str, str],
+    partition_by: str | None = None,
+):
+    """
+    Create a history table (schema only, plus `history_columns`) from a table if it doesn't
+    exist, and add any column the table gained since.
+
+    With `partition_by`, the history table is partitioned by LIST on that column (the
+    partitions themselves are created by the caller). Existing non-partitioned history
+    tables are converted by scripts/db-migrate.ts.
+
+    Returns:
+        The quoted, comma-separated list of the table's columns
+    """
+    # Check if history table exists
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s);", (history_table_name,))
+    row = cur.fetchone()
+    relkind = row[0] if row else None
+
+    if relkind is None:
+        if partition_by:
+            columns = get_column_definitions(cur, table_name) + list(history_columns.items())
+            create_partitioned_table(cur, history_table_name, columns, partition_by)
+        else:
+            # Create the history table by copying schema ONLY from the original
+            cur.execute(f"CREATE TABLE {history_table_name} AS TABLE {table_name} WITH NO DATA;")
+            # Add the history columns
             cur.execute(
-                """
-                SELECT a.attname AS column_name, format_type(a.atttypid, a.atttypmod) AS column_type
-                FROM pg_attribute a
-                WHERE a.attrelid = %s::regclass
-                  AND a.attnum > 0
-                  AND NOT a.attisdropped
-                ORDER BY a.attnum;
-            """,
-                (table_name,),
+                f"ALTER TABLE {history_table_name} "
+                + ", ".join(
+                    f"ADD COLUMN {name} {column_type}"
+                    for name, column_type in history_columns.items()
+                )
+                + ";"
             )
-            source_columns = cur.fetchall()
-            columns = [row[0] for row in source_columns]
-            column_list = ", ".join(f'"{col}"' for col in columns)  # Quote column names
-
-            # The history table's schema is otherwise only set once, above, when it's
-            # first created. Columns added to the source table by a later migration
-            # would silently be missing from *_history and break every subsequent
-            # INSERT below, so reconcile any drift on every run instead.
+    elif partition_by and relkind == "r":
+        # Created before history tables were partitioned: converted once by
+        # scripts/db-migrate.ts, as it can take longer than a historization
+        raise Exception(f"{history_table_name} isn't partitioned yet, run `make db-migrate`")
+
+    # Get column names (and types, to reconcile drift below) from the original
+    # table. This needs to be done *after* potential table creation.
+    source_columns = get_column_definitions(cur, table_name)
+    columns = [row[0] for row in source_columns]
+
+    # The history table's schema is otherwise only set once, above, when it's
+    # first created. Columns added to the source table by a later migration
+    # would silently be missing from *_history and break every subsequent
+    # INSERT, so reconcile any drift on every run instead.
+    cur.execute(
+        """
+        SELECT a.attname
+        FROM pg_attribute a
+        WHERE a.attrelid = %s::regclass
+          AND a.attnum > 0
+          AND NOT a.attisdropped;
+    """,
+        (history_table_name,),
+    )
+    existing_history_columns = {row[0] for row in cur.fetchall()}
+    for column_name, column_type in source_columns:
+        if column_name not in existing_history_columns:
             cur.execute(
-                """
-                SELECT a.attname
-                FROM pg_attribute a
-                WHERE a.attrelid = %s::regclass
-                  AND a.attnum > 0
-                  AND NOT a.attisdropped;
-            """,
-                (history_table_name,),
+                f'ALTER TABLE {history_table_name} ADD COLUMN "{column_name}" {column_type};'
             )
-            existing_history_columns = {row[0] for row in cur.fetchall()}
-            for column_name, column_type in source_columns:
-                if column_name not in existing_history_columns:
-                    cur.execute(
-                        f'ALTER TABLE {history_table_name} '
-                        f'ADD COLUMN "{column_name}" {column_type};'
-                    )
+
+    return ", ".join(f'"{col}"' for col in columns)  # Quote column names
+
+
+def export_snapshot(cur) -> str:
+    """
+    Start a read-only REPEATABLE READ transaction and export its snapshot, so that other
+    connections can see the exact same data with import_snapshot while it stays open.
+    """
+    cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;")
+    cur.execute("SELECT pg_export_snapshot();")
+    return cur.fetchone()[0]
+
+
+class TableNotInSnapshot(Exception):
+    """The table was replaced (dropped and recreated) after the snapshot was exported"""
+
+
+def import_snapshot(cur, snapshot: str, table_name: Optional[str] = None):
+    """
+    Make the (new) transaction of a cursor see the data of an exported snapshot.
+
+    Raises TableNotInSnapshot if `table_name` was replaced since: the snapshot sees
+    neither its rows nor its columns.
+    """
+    cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;")
+    cur.execute("SET TRANSACTION SNAPSHOT %s;", (snapshot,))
+    if table_name:
+        # The name is resolved with the latest catalog, its pg_class row with the snapshot
+        cur.execute(
+            "SELECT EXISTS (SELECT FROM pg_class WHERE oid = %s::regclass);", (table_name,)
+        )
+        if not cur.fetchone()[0]:
+            raise TableNotInSnapshot(f"{table_name} was replaced after the snapshot")
+
+
+def create_history_partition(cur, history_table_name: str, history_month: str):
+    """Create the partition of a history table for a month, if it doesn't exist yet"""
+    partition_name = f"{history_table_name}_{history_month.replace('-', '_')}"
+    cur.execute(
+        f"CREATE TABLE IF NOT EXISTS {partition_name} "
+        f"PARTITION OF {history_table_name} FOR VALUES IN (%s);",
+        (history_month,),
+    )
+
+
+def historize_table(table_name: str, mode: str = "snapshot", snapshot: Optional[str] = None):
+    """
+    Historize the current data from a table.
+
+    In "snapshot" mode, appends it to its corresponding `*_history` table, adding
+    `history_date` (DATE) and `history_month` (VARCHAR(7)) columns with the current
+    date and month. That table is partitioned by `history_month`, one partition per
+    month, and indexed on (siret, history_month) when the table has a siret.
+
+    In "delta" mode, only records the changes in its `*_history_delta` table: each
+    distinct row is stored once with the `valid_from` month it appeared and the
+    `valid_to` month it disappeared (NULL while it still exists). Use
+    get_history_as_of to read the table as of a given month.
+
+    Creates the history table (schema only) if it doesn't exist.
+
+    Args:
+        table_name: The name of the table to historize.
+        mode: "snapshot" or "delta".
+        snapshot: An exported snapshot (see export_snapshot) to read the table as of.
+
+    Returns:
+        The number of history rows written: {"rows": n} in "snapshot" mode,
+        {"added": n, "removed": n} in "delta" mode.
+    """
+    if mode == "delta":
+        return historize_table_delta(table_name, snapshot=snapshot)
+
+    history_table_name = f"{table_name}_history"
+
+    with get_db() as db:
+        with db.cursor() as cur:
+            if snapshot:
+                import_snapshot(cur, snapshot, table_name)
+            column_list = prepare_history_table(
+                cur,
+                table_name,
+                history_table_name,
+                SNAPSHOT_HISTORY_COLUMNS,
+                partition_by="history_month",
+            )
+            if '"siret"' in column_list.split(", "):
+                cur.execute(f"""
+                    CREATE INDEX IF NOT EXISTS idx_{history_table_name}_siret
+                    ON {history_table_name} (siret, history_month);
+                """)
+
+            cur.execute("SELECT CURRENT_DATE, TO_CHAR(NOW(), 'YYYY-MM');")
+            history_date, history_month = cur.fetchone()
+            create_history_partition(cur, history_table_name, history_month)
 
             # Insert current data from original table into history table,
             # adding the current date and month for the new history columns.
             # This runs regardless of whether the table was just created or already existed.
             insert_column_list = f"{column_list}, history_date, history_month"
-            select_column_list = f"{column_list}, CURRENT_DATE, TO_CHAR(NOW(), 'YYYY-MM')"
+            select_column_list = f"{column_list}, %s, %s"
 
-            cur.execute(f"""
+            cur.execute(
+                f"""
                 INSERT INTO {history_table_name} ({insert_column_list})
                 SELECT {select_column_list}
                 FROM {table_name};
+            """,  # noqa: S608
+                (history_date, history_month),
+            )
+            counts = {"rows": cur.rowcount}
+
+        db.commit()
+    return counts
+
+
+def historize_table_delta(table_name: str, snapshot: Optional[str] = None):
+    """Record the rows of a table that appeared or disappeared since the last run"""
+    history_table_name = f"{table_name}_history_delta"
+
+    with get_db() as db:
+        with db.cursor() as cur:
+            if snapshot:
+                import_snapshot(cur, snapshot, table_name)
+            column_list = prepare_history_table(
+                cur,
+                table_name,
+                history_table_name,
+                DELTA_HISTORY_COLUMNS,
+            )
+            cur.execute(f"""
+                CREATE INDEX IF NOT EXISTS idx_{history_table_name}_current
+                ON {history_table_name} (row_hash) WHERE valid_to IS NULL;
+                CREATE INDEX IF NOT EXISTS idx_{history_table_name}_validity
+                ON {history_table_name} (valid_from, valid_to);
+            """)
+
+            # Identical rows are numbered so that duplicates each keep their own hash
+            cur.execute(f"""
+                CREATE TEMPORARY TABLE historize_current ON COMMIT DROP AS
+                SELECT {column_list}, md5(
+                    ROW({column_list})::text || ':' ||
+                    row_number() OVER (PARTITION BY ROW({column_list})::text)
+                ) AS row_hash
+                FROM {table_name};
             """)  # noqa: S608
 
+            # Close the rows that are gone, then open the rows that are new
+            cur.execute(f"""
+                UPDATE {history_table_name} h SET valid_to = TO_CHAR(NOW(), 'YYYY-MM')
+                WHERE h.valid_to IS NULL
+                  AND NOT EXISTS (SELECT 1 FROM historize_current c WHERE c.row_hash = h.row_hash);
+            """)  # noqa: S608
+            closed_count = cur.rowcount
+            cur.execute(f"""
+                INSERT INTO {history_table_name} ({column_list}, row_hash, valid_from)
+                SELECT {column_list}, row_hash, TO_CHAR(NOW(), 'YYYY-MM')
+                FROM historize_current c
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM {history_table_name} h
+                    WHERE h.valid_to IS NULL AND h.row_hash = c.row_hash
+                );
+            """)  # noqa: S608
+            counts = {"added": cur.rowcount, "removed": closed_count}
+            logger.info(
+                "Historized %s: %d rows added, %d rows removed",
+                table_name,
+                counts["added"],
+                counts["removed"],
+            )
+
         db.commit()
+    return counts
+
+
+def get_history_as_of(table_name: str, month: str):
+    """
+    Get the rows of a table as they were historized for a given month ("YYYY-MM").
+
+    Reads the `*_history_delta` table, or the `*_history` snapshots for the months
+    before the table was historized in "delta" mode.
+    """
+    with get_db() as db:
+        with db.cursor() as cur:
+            cur.execute(
+                "SELECT to_regclass(%s) IS NOT NULL, to_regclass(%s) IS NOT NULL",
+                (f"{table_name}_history_delta", f"{table_name}_history"),
+            )
+            has_delta, has_snapshots = cur.fetchone()
+
+            if has_delta:
+                cur.execute(
+                    f"SELECT MIN(valid_from) FROM {table_name}_history_delta"  # noqa: S608
+                )
+                first_month = cur.fetchone()[0]
+                if first_month and month >= first_month:
+                    cur.execute(
+                        f"""
+                        SELECT * FROM {table_name}_history_delta
+                        WHERE valid_from <= %(month)s
+                          AND (valid_to IS NULL OR valid_to > %(month)s)
+                        """,  # noqa: S608
+                        {"month": month},
+                    )
+                    return [
+                        {k: v for k, v in row.items() if k not in DELTA_HISTORY_COLUMNS}
+                        for row in cur.fetchall()
+                    ]
+
+            if not has_snapshots:
+                return []
+
+            cur.execute(
+                f"SELECT * FROM {table_name}_history WHERE history_month = %s",  # noqa: S608
+                (month,),
+            )
+            return [
+                {k: v for k, v in row.items() if k not in SNAPSHOT_HISTORY_COLUMNS}
+                for row in cur.fetchall()
+            ]
 
 
-def calculate_stats_for_scope(communes, scope_communes):
+RCPNT_POPULATION_RANGES = [200, 500, 1000, 2000, 3500, 5000, 10000, 20000, 50000, 100000]
+
+
+def get_population_range(population):
+    min_pop = 0
+    for max_pop in RCPNT_POPULATION_RANGES:
+        if population <= max_pop:
+            return f"{min_pop}-{max_pop}"
+        min_pop = max_pop
+    return "100000-"
+
+
+def rcpnt_frame(orgs: list):
+    """Load orgs in a boolean matrix of orgs × RCPNT refs, along with their SIRET and population"""
+    refs = sorted(RcpntRefs)
+    frame = pd.DataFrame(
+        [[ref in org.get("_st_rcpnt", ()) for ref in refs] for org in orgs],
+        columns=refs,
+        dtype=bool,
+    )
+    frame["siret"] = [org["siret"] for org in orgs]
+    frame["population"] = [org["population"] for org in orgs]
+    frame["valid_refs"] = [len(org.get("_st_rcpnt", ())) for org in orgs]
+    return frame
+
+
+def calculate_stats_for_scopes(scope, frame, scope_ids: list):
     """
-    Calculate statistics for a given scope of communes.
+    Calculate statistics for every group of orgs of a scope at once, by summing the
+    matrix built by rcpnt_frame per group. Orgs whose scope_id is empty are left out.
 
     Args:
-        communes: List of all communes for sampling without_issue
-        scope_communes: List of communes in this scope
+        scope: Name of the scope
+        frame: Orgs, as returned by rcpnt_frame
+        scope_ids: Scope id of each org
 
     Returns:
-        List of tuples (issue, count, total, sample_with, sample_without)
+        List of tuples (scope, scope_id, ref, valid, total, valid_pop, total_pop,
+        sample_valid, sample_invalid)
     """
-    total = len(scope_communes)
+    refs = sorted(RcpntRefs)
+
+    frame = frame.assign(scope_id=[scope_id or "" for scope_id in scope_ids])
+    frame = frame[frame["scope_id"] != ""]
+
+    # Invalid samples are picked among the orgs with the fewest other issues, so
+    # sort them first: groups then list their orgs in that order.
+    frame = frame.sort_values("valid_refs", ascending=False, kind="stable")
+    frame = frame.reset_index(drop=True)
+
+    grouped = frame.groupby("scope_id", sort=False)
+    valid = grouped[refs].sum()
+    valid_pop = frame[refs].mul(frame["population"], axis=0).groupby(frame["scope_id"]).sum()
+    valid = dict(zip(valid.index, valid.to_numpy().tolist(), strict=True))
+    valid_pop = dict(zip(valid_pop.index, valid_pop.to_numpy().tolist(), strict=True))
+    total = grouped.size().to_dict()
+    total_pop = grouped["population"].sum().to_dict()
+
+    matrix = frame[refs].to_numpy()
+    sirets = frame["siret"].to_numpy()
+
     stats = []
+    for scope_id, positions in grouped.indices.items():
+        group_matrix = matrix[positions]
+        group_sirets = sirets[positions]
 
-    # Pre-compute siret lookup for scope_communes
-    scope_sirets = {c["siret"] for c in scope_communes}
-
-    # Pre-compute RCPNT conformance for all communes
-    conformity_map = defaultdict(set)
-    pop_map = {c["siret"]: c["population"] for c in scope_communes}
-    for c in scope_communes:
-        for ref in c.get("_st_rcpnt", []):
-            conformity_map[ref].add(c["siret"])
-
-    for ref in RcpntRefs:
-        valid = conformity_map.get(ref, set())
-        count = len(valid)
-        count_pop = sum(pop_map.get(siret, 0) for siret in valid)
-        total_pop = sum(pop_map.get(siret, 0) for siret in scope_sirets)
-
-        # Get samples - convert sets to lists for random.sample
-        sample_valid = random.sample(list(valid), min(3, count)) if valid else []
-        sample_invalid = []
-        invalid = scope_sirets - valid
-
-        # Pick invalid samples with the fewest other issues
-        if invalid:
-            # Create a map to count issues for invalid SIRETs
-            valid_count = dict.fromkeys(invalid, 0)
-            for c in scope_communes:
-                if c["siret"] in invalid:
-                    valid_count[c["siret"]] += len(c.get("_st_rcpnt", []))
-
-            # Sort invalid SIRETs by issue count and select samples
-            least_issues_invalid = sorted(
-                invalid, key=lambda siret: valid_count[siret], reverse=True
-            )[0:12]
-            sample_invalid = random.sample(least_issues_invalid, min(3, len(least_issues_invalid)))
-
-        stats.append((ref, count, total, count_pop, total_pop, sample_valid, sample_invalid))
+        for i, ref in enumerate(refs):
+            valid_sirets = group_sirets[group_matrix[:, i]]
+            invalid_sirets = group_sirets[~group_matrix[:, i]][0:12]
+            stats.append(
+                (
+                    scope,
+                    scope_id,
+                    ref,
+                    valid[scope_id][i],
+                    int(total[scope_id]),
+                    valid_pop[scope_id][i],
+                    int(total_pop[scope_id]),
+                    [
+                        str(valid_sirets[x])
+                        for x in random.sample(range(len(valid_sirets)), min(3, len(valid_sirets)))
+                    ],
+                    [
+                        str(invalid_sirets[x])
+                        for x in random.sample(
+                            range(len(invalid_sirets)), min(3, len(invalid_sirets))
+                        )
+                    ],
+                )
+            )
 
     return stats
 
 
-def update_rcpnt_stats(orgs: list):
+# Share of orgs whose RCPNT state may change before update_rcpnt_stats falls back to
+# a full rebuild instead of an incremental update
+RCPNT_STATS_INCREMENTAL_MAX_RATIO = 0.2
+
+
+def get_rcpnt_scope_ids(org) -> dict:
     """
-    Create and populate the data_rcpnt_stats table with statistics about each RCPNT criterion,
-    segmented by different geographical scopes.
+    Get the scope id of an org for each scope of data_rcpnt_stats it counts in.
+    The "global" scopes have a single group, stored with a NULL scope_id.
     """
-
     # TODO: stats for EPCIs ?
-    communes = [x for x in orgs if x["type"] == "commune"]
-    epcis = [x for x in orgs if x["type"] == "epci"]
+    if org["type"] == "epci":
+        return {"global-epci": "global"}
+    if org["type"] == "commune":
+        return {
+            "global": "global",
+            "epci": org.get("_st_epci", {}).get("siren") or "",
+            "dep": org["insee_dep"],
+            "reg": org["insee_reg"],
+            "pop": get_population_range(org["population"]),
+        }
+    return {}
 
-    population_ranges = [200, 500, 1000, 2000, 3500, 5000, 10000, 20000, 50000, 100000]
 
-    def get_population_range(population):
-        min_pop = 0
-        for max_pop in population_ranges:
-            if population <= max_pop:
-                return f"{min_pop}-{max_pop}"
-            min_pop = max_pop
-        return "100000-"
+def get_rcpnt_state(org) -> dict:
+    """Everything about an org that its RCPNT statistics depend on"""
+    return {
+        "population": org["population"],
+        "rcpnt": sorted(org.get("_st_rcpnt", ())),
+        "scopes": get_rcpnt_scope_ids(org),
+    }
 
-    # Define scopes configuration
+
+def calculate_rcpnt_stats(orgs: list, only_groups: Optional[set] = None):
+    """
+    Calculate the statistics about each RCPNT criterion, for every scope.
+
+    Args:
+        orgs: List of all orgs
+        only_groups: If set, only calculate the stats of these (scope, scope_id) groups
+
+    Returns:
+        List of tuples (scope, scope_id, ref, valid, total, valid_pop, total_pop,
+        sample_valid, sample_invalid)
+    """
+
+    orgs_by_type = {
+        "commune": [x for x in orgs if x["type"] == "commune"],
+        "epci": [x for x in orgs if x["type"] == "epci"],
+    }
     scopes = [
-        {"name": "global", "group_by": lambda c: None},
-        {"name": "global-epci", "group_by": lambda c: None},
-        {"name": "epci", "group_by": lambda c: c.get("_st_epci", {}).get("siren") or None},
-        {"name": "dep", "group_by": lambda c: c["insee_dep"]},
-        {"name": "reg", "group_by": lambda c: c["insee_reg"]},
-        {
-            "name": "pop",
-            "group_by": lambda c: get_population_range(c["population"]),
-        },
+        ("global", "commune"),
+        ("global-epci", "epci"),
+        ("epci", "commune"),
+        ("dep", "commune"),
+        ("reg", "commune"),
+        ("pop", "commune"),
     ]
+    frames = {}
+
+    stats = []
+    for scope, org_type in scopes:
+        scope_orgs = orgs_by_type[org_type]
+        scope_ids = [get_rcpnt_scope_ids(org)[scope] for org in scope_orgs]
+        if only_groups is not None:
+            scope_ids = [x if (scope, x) in only_groups else "" for x in scope_ids]
+            if not any(scope_ids):
+                continue
 
+        if org_type not in frames:
+            frames[org_type] = rcpnt_frame(scope_orgs)
+
+        scope_stats = calculate_stats_for_scopes(scope, frames[org_type], scope_ids)
+        if scope.startswith("global"):
+            scope_stats = [(x[0], None, *x[2:]) for x in scope_stats]
+        stats.extend(scope_stats)
+
+    return stats
+
+
+def get_rcpnt_states():
+    """Get the RCPNT state of each org, as of the last update_rcpnt_stats"""
+    with get_db() as db:
+        with db.cursor() as cur:
+            cur.execute("SELECT to_regclass('data_rcpnt_stats') IS NOT NULL")
+            if not cur.fetchone()[0]:
+                return {}
+            cur.execute("SELECT siret, state FROM data_rcpnt_states")
+            return {row["siret"]: row["state"] for row in cur.fetchall()}
+
+
+def update_rcpnt_stats(orgs: list, full: bool = False):
+    """
+    Create and populate the data_rcpnt_stats table with statistics about each RCPNT criterion,
+    segmented by different geographical scopes.
+
+    Unless `full` is set, only the groups of the orgs whose RCPNT state changed since the
+    last run are recalculated. We fall back to a full rebuild when there is no previous
+    state or too many orgs changed.
+    """
+
+    states = {
+        org["siret"]: get_rcpnt_state(org) for org in orgs if org["type"] in {"commune", "epci"}
+    }
+    previous_states = {} if full else get_rcpnt_states()
+
+    changed_sirets = {
+        siret
+        for siret in states.keys() | previous_states.keys()
+        if states.get(siret) != previous_states.get(siret)
+    }
+
+    if len(previous_states) == 0 or len(changed_sirets) > RCPNT_STATS_INCREMENTAL_MAX_RATIO * len(
+        states
+    ):
+        rebuild_rcpnt_stats(orgs, states)
+        return
+
+    changed_groups = {
+        (scope, scope_id)
+        for siret in changed_sirets
+        for state in (states.get(siret), previous_states.get(siret))
+        if state
+        for scope, scope_id in state["scopes"].items()
+        if scope_id
+    }
+    logger.info(
+        "%d orgs changed since the last RCPNT stats, updating %d groups",
+        len(changed_sirets),
+        len(changed_groups),
+    )
+
+    stats = calculate_rcpnt_stats(orgs, only_groups=changed_groups)
+
+    with get_db() as db:
+        with db.cursor() as cur:
+            execute_values(
+                cur,
+                """
+                DELETE FROM data_rcpnt_stats USING (VALUES %s) AS changed (scope, scope_id)
+                WHERE data_rcpnt_stats.scope = changed.scope
+                  AND COALESCE(data_rcpnt_stats.scope_id, 'global') = changed.scope_id
+                """,
+                list(changed_groups),
+                page_size=1000,
+            )
+            execute_values(
+                cur,
+                """
+                INSERT INTO data_rcpnt_stats
+                (scope, scope_id, ref, valid, total, valid_pop, total_pop, sample_valid, sample_invalid, last_updated)
+                VALUES %s
+                """,
+                stats,
+                template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, now())",
+                page_size=1000,
+            )
+
+            cur.execute(
+                "DELETE FROM data_rcpnt_states WHERE siret = ANY(%s)",
+                (list(changed_sirets - states.keys()),),
+            )
+            execute_values(
+                cur,
+                """
+                INSERT INTO data_rcpnt_states (siret, state) VALUES %s
+                ON CONFLICT (siret) DO UPDATE SET state = EXCLUDED.state
+                """,
+                [(siret, json.dumps(states[siret])) for siret in changed_sirets & states.keys()],
+                page_size=1000,
+            )
+
+            db.commit()
+
+
+def rebuild_rcpnt_stats(orgs: list, states: dict):
+    """Recalculate all the RCPNT stats, and the RCPNT state of each org"""
+
+    stats = calculate_rcpnt_stats(orgs)
+
+    # Load the stats in a staging table, then swap it in place of the current one in
+    # the same transaction: readers keep seeing the previous stats until the commit.
     with get_db() as db:
         with db.cursor() as cur:
-            # Drop and recreate the table with index
             cur.execute("""
-                DROP TABLE IF EXISTS data_rcpnt_stats;
-                CREATE TABLE data_rcpnt_stats (
+                DROP TABLE IF EXISTS data_rcpnt_stats_new;
+                CREATE TABLE data_rcpnt_stats_new (
                     scope VARCHAR(16) NOT NULL,
                     scope_id VARCHAR(16),
                     ref VARCHAR(8) NOT NULL,
@@ -340,56 +1152,37 @@ def update_rcpnt_stats(orgs: list):
                     sample_invalid VARCHAR(14)[] NOT NULL,
                     last_updated TIMESTAMP WITH TIME ZONE NOT NULL
                 );
-                CREATE INDEX idx_data_rcpnt_stats_scope ON data_rcpnt_stats (scope, scope_id);
-                CREATE INDEX idx_data_rcpnt_stats_ref ON data_rcpnt_stats (scope, ref);
             """)
 
-            # Process each scope
-            for scope in scopes:
-                all_scope = communes
-
-                # Group communes by scope
-                if scope["name"] == "global":
-                    groups = {None: communes}
-                elif scope["name"] == "global-epci":
-                    groups = {None: epcis}
-                    all_scope = epcis
-                else:
-                    groups = defaultdict(list)
-                    for commune in communes:
-                        scope_id = scope["group_by"](commune)
-                        if scope_id:
-                            groups[scope_id].append(commune)
-
-                # Calculate and insert stats for each group
-                for scope_id, scope_communes in groups.items():
-                    stats = calculate_stats_for_scope(all_scope, scope_communes)
-                    for (
-                        ref,
-                        valid,
-                        total,
-                        valid_pop,
-                        total_pop,
-                        sample_valid,
-                        sample_invalid,
-                    ) in stats:
-                        cur.execute(
-                            """
-                            INSERT INTO data_rcpnt_stats
-                            (scope, scope_id, ref, valid, total, valid_pop, total_pop, sample_valid, sample_invalid, last_updated)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, now())
-                            """,
-                            (
-                                scope["name"],
-                                scope_id,
-                                ref,
-                                valid,
-                                total,
-                                valid_pop,
-                                total_pop,
-                                sample_valid,
-                                sample_invalid,
-                            ),
-                        )
+            execute_values(
+                cur,
+                """
+                INSERT INTO data_rcpnt_stats_new
+                (scope, scope_id, ref, valid, total, valid_pop, total_pop, sample_valid, sample_invalid, last_updated)
+                VALUES %s
+                """,
+                stats,
+                template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, now())",
+                page_size=1000,
+            )
+
+            # Indexes are cheaper to build after the load
+            cur.execute("""
+                CREATE INDEX idx_data_rcpnt_stats_new_scope ON data_rcpnt_stats_new (scope, scope_id);
+                CREATE INDEX idx_data_rcpnt_stats_new_ref ON data_rcpnt_stats_new (scope, ref);
+
+                DROP TABLE IF EXISTS data_rcpnt_stats;
+                ALTER TABLE data_rcpnt_stats_new RENAME TO data_rcpnt_stats;
+                ALTER INDEX idx_data_rcpnt_stats_new_scope RENAME TO idx_data_rcpnt_stats_scope;
+                ALTER INDEX idx_data_rcpnt_stats_new_ref RENAME TO idx_data_rcpnt_stats_ref;
+            """)
+
+            cur.execute("TRUNCATE data_rcpnt_states")
+            execute_values(
+                cur,
+                "INSERT INTO data_rcpnt_states (siret, state) VALUES %s",
+                [(siret, json.dumps(state)) for siret, state in states.items()],
+                page_size=1000,
+            )
 
             db.commit()
@@ -1,16 +1,17 @@
+import codecs
 import csv
 import gzip
 import io
 import json
 import logging
 import os
-import signal
-import subprocess
 import zipfile
+import zlib
 from pathlib import Path
 
 import requests
 
+from .db import get_sirene_extract, get_sirene_extract_version, save_sirene_extract
 from .defs import FORCE_INCLUDE_SIRENE
 
 logger = logging.getLogger(__name__)
@@ -163,113 +164,207 @@ def dump_insee_population():
         json.dump(data, f, ensure_ascii=False, indent=4)
 
 
+def get_response_total_length(response):
+    """The length of the whole remote file, from the headers of a (partial) response"""
+    content_range = response.headers.get("Content-Range", "")
+    if "/" in content_range and not content_range.endswith("/*"):
+        return int(content_range.rsplit("/", 1)[1])
+    if response.status_code == 200 and "Content-Encoding" not in response.headers:
+        content_length = response.headers.get("Content-Length")
+        return int(content_length) if content_length else None
+    return None
+
+
+def iter_remote_gzip_lines(url, max_resumes=20, chunk_size=1024 * 1024):
+    """Stream the text lines of a remote gzip file, resuming with HTTP Range requests.
+
+    The compressed byte offset and the decompressor state are checkpointed after every
+    chunk, so a connection that dies halfway resumes from that offset instead of
+    re-downloading the file from byte zero.
+    """
+    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    offset = 0
+    length = None
+    pending = ""
+    resumes = 0
+
+    while True:
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            with requests.get(url, headers=headers, stream=True, timeout=60) as response:
+                length = get_response_total_length(response) or length
+                if response.status_code == 416 and offset and offset == length:
+                    # We already have every byte of the file: it ends before the end of
+                    # its gzip stream, so there is nothing left to resume
+                    logger.warning("Stream of %s ended before its gzip trailer", url)
+                    break
+                response.raise_for_status()
+                if offset and response.status_code != 206:
+                    raise RuntimeError(f"Server ignored the Range request to resume {url}")
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    # Decompress on copies so that a corrupt chunk leaves the last
+                    # checkpoint intact and can be fetched again.
+                    next_decompressor = decompressor.copy()
+                    next_decoder = codecs.getincrementaldecoder("utf-8")()
+                    next_decoder.setstate(decoder.getstate())
+                    text = next_decoder.decode(next_decompressor.decompress(chunk))
+                    # Concatenated gzip members are valid gzip: start a new member.
+                    while next_decompressor.eof and next_decompressor.unused_data:
+                        unused_data = next_decompressor.unused_data
+                        next_decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+                        text += next_decoder.decode(next_decompressor.decompress(unused_data))
+
+                    offset += len(chunk)
+                    decompressor, decoder = next_decompressor, next_decoder
+                    *lines, pending = (pending + text).split("\n")
+                    yield from lines
+        except (
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            zlib.error,
+        ) as e:
+            logger.warning("Stream of %s interrupted at byte %d: %s", url, offset, e)
+
+        if decompressor.eof:
+            break
+
+        resumes += 1
+        if resumes > max_resumes:
+            raise RuntimeError(f"Stream of {url} still incomplete after {max_resumes} resumes")
+        logger.warning("Resuming stream of %s from byte %d", url, offset)
+
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+def get_remote_version(url):
+    """Identify the current version of a remote file by its ETag or Last-Modified header"""
+    r = requests.head(url, allow_redirects=True, timeout=30)
+    r.raise_for_status()
+    return r.headers.get("ETag") or r.headers.get("Last-Modified")
+
+
+SIRENE_STOCK_URL = "https://www.data.gouv.fr/fr/datasets/r/0651fb76-bcf3-4f6a-a38d-bc04fa708576"
+
+
+def get_sirene_stock_version():
+    """
+    Identify the current version of the SIRENE stock file. When data.gouv doesn't tell
+    (request error, no ETag nor Last-Modified), fall back to the version of the persisted
+    extract. Returns (version, is_current), version being None if neither is known.
+    """
+    try:
+        stock_version = get_remote_version(SIRENE_STOCK_URL)
+    except requests.RequestException as e:
+        logger.warning("Could not get the SIRENE stock version: %s", e)
+        stock_version = None
+    if stock_version:
+        return stock_version, True
+
+    stock_version = get_sirene_extract_version()
+    if stock_version:
+        logger.warning("Falling back to the persisted SIRENE extract of stock %s", stock_version)
+    return stock_version, False
+
+
 def dump_filtered_sirene(orgs):
     # https://www.data.gouv.fr/fr/datasets/base-sirene-des-entreprises-et-de-leurs-etablissements-siren-siret/
     if Path("dumps/sirene.json").exists():
         return
 
-    orgs_sirens = {org["siren"] for org in orgs}
+    orgs_sirens = {org["siren"] for org in orgs if org.get("siren")}
+
+    url = SIRENE_STOCK_URL
+
+    # The stock file is only republished monthly, so we keep a persisted extract of
+    # the rows we need (see get_sirene_extract). It is reused as long as the stock
+    # is unchanged and already covers every SIREN we look for; otherwise we stream.
+    # When the stock version is unknown, the last extract is reused, but what we
+    # stream isn't persisted since we can't tell which stock it comes from.
+    stock_version, is_current = get_sirene_stock_version()
+    extract = get_sirene_extract(orgs_sirens, stock_version) if stock_version else {}
+    if orgs_sirens.issubset(extract.keys()):
+        logger.info("Using the persisted SIRENE extract for stock %s", stock_version)
+        rows = [row for row in extract.values() if row]
+    else:
+        rows = stream_filtered_sirene(url, orgs_sirens)
+        if is_current:
+            save_sirene_extract(orgs_sirens, rows, stock_version)
 
-    url = "https://www.data.gouv.fr/fr/datasets/r/0651fb76-bcf3-4f6a-a38d-bc04fa708576"
+    with open("dumps/sirene.json", "w") as f:
+        json.dump(rows, f, ensure_ascii=False, indent=4)
+
+    return len(rows)
 
-    # The sed pre-filter keeps only lines with NAF 84.11Z to shrink the stream.
-    # Force-included SIRENs (siège mis-coded or cessée) must survive it too, so we
-    # add a print rule per SIREN. Digits only, safe inside the single-quoted script.
-    force_rules = "".join(f";/{siren}/p" for siren in FORCE_INCLUDE_SIRENE)
+
+def stream_filtered_sirene(url, orgs_sirens):
+    """Stream the SIRENE stock file and return the siège rows of the given SIRENs"""
 
     # All the SIRENs we care about are territorial collectivities, which live in the
     # low 20x–24x range. SIRENE is sorted by SIREN ascending, so once the stream
     # passes our highest target we have already seen every relevant row.
     max_target = max(int(s) for s in orgs_sirens if s and s.isdigit())
 
-    # The data.gouv stream truncates intermittently at the far end ("gzip: invalid
-    # compressed data--length error") — but that tail is millions of unrelated
-    # companies with high SIRENs. We stream (curl | zcat | sed) to avoid storing the
-    # multi-GB file on disk, and stop as soon as we pass max_target: the truncation
-    # is never reached, and we skip ~95% of the file. We only retry when the stream
-    # dies *before* reaching that point (a genuinely incomplete read).
-    def stream_rows():
-        # No `curl --retry` here: retrying inside a running pipe would re-send bytes
-        # into zcat and corrupt the stream. We retry the whole pipeline instead.
-        process = subprocess.Popen(
-            f"set -o pipefail; curl -sfL --connect-timeout 30 '{url}' "
-            f"| zcat | sed -n '1p;/84.11Z/p{force_rules}'",
-            shell=True,
-            executable="/bin/bash",
-            stdout=subprocess.PIPE,
-            text=True,
-            start_new_session=True,
-        )
+    # The data.gouv stream truncates intermittently ("gzip: invalid compressed
+    # data--length error"). We stream it without storing the multi-GB file on disk,
+    # resume truncated reads with HTTP Range requests (see iter_remote_gzip_lines),
+    # and stop as soon as we pass max_target, skipping ~95% of the file.
+    lines = iter_remote_gzip_lines(url)
+    try:
+        fieldnames = next(csv.reader([next(lines)]))
+        rows = []
         seen = set()
-        collected = []
         passed_range = False
         prev_siren = 0
-        disordered = False
-        try:
-            reader = csv.DictReader(process.stdout, delimiter=",")
-            for row in reader:
-                siren = row["siren"]
-                if not siren.isdigit():
-                    continue
-                siren_int = int(siren)
-                # The early-exit below is only sound if SIRENs arrive in ascending
-                # order. That isn't a guarantee we found documented, so we verify it
-                # as we go and abort loudly rather than risk silently dropping a row.
-                if siren_int < prev_siren:
-                    disordered = True
-                    break
-                prev_siren = siren_int
-                if (
-                    siren in orgs_sirens
-                    and siren not in seen
-                    and row.get("etablissementSiege") == "true"
-                    # Force-included SIRENs keep their siège row regardless of NAF/état.
-                    and (
-                        siren in FORCE_INCLUDE_SIRENE
-                        or row.get("etatAdministratifEtablissement") == "A"
-                    )
-                ):
-                    collected.append(row)
-                    seen.add(siren)
-                if siren_int > max_target:
-                    passed_range = True
-                    break
-        finally:
-            # Tear down the whole pipeline (curl would keep downloading otherwise).
-            try:
-                os.killpg(os.getpgid(process.pid), signal.SIGTERM)
-            except (ProcessLookupError, PermissionError):
-                pass
-            process.stdout.close()
-            returncode = process.wait()
-
-        if disordered:
-            raise RuntimeError(
-                "SIRENE stream is not sorted by SIREN ascending; the early-exit would "
-                "risk dropping rows. Aborting instead of writing an incomplete dump."
-            )
-
-        # Complete if we passed the target range, or the stream reached a clean EOF.
-        return (passed_range or returncode == 0), collected
-
-    rows = None
-    for attempt in range(6):
-        complete, collected = stream_rows()
-        if complete and len(collected) > 30000:
-            rows = collected
-            break
-        logger.warning(
-            "SIRENE stream attempt %d incomplete (%d rows), retrying",
-            attempt + 1,
-            len(collected),
-        )
-    else:
-        raise RuntimeError("Could not stream a complete SIRENE dump after retries")
-
-    with open("dumps/sirene.json", "w") as f:
-        json.dump(rows, f, ensure_ascii=False, indent=4)
+        for line in lines:
+            # Cheap pre-filter before CSV parsing: keep only lines with NAF 84.11Z,
+            # plus force-included SIRENs (siège mis-coded or cessée). The SIREN is
+            # the first column.
+            if "84.11Z" not in line and line[:9] not in FORCE_INCLUDE_SIRENE:
+                continue
+            row = dict(zip(fieldnames, next(csv.reader([line])), strict=False))
+            siren = row["siren"]
+            if not siren.isdigit():
+                continue
+            siren_int = int(siren)
+            # The early-exit below is only sound if SIRENs arrive in ascending
+            # order. That isn't a guarantee we found documented, so we verify it
+            # as we go and abort loudly rather than risk silently dropping a row.
+            if siren_int < prev_siren:
+                raise RuntimeError(
+                    "SIRENE stream is not sorted by SIREN ascending; the early-exit would "
+                    "risk dropping rows. Aborting instead of writing an incomplete dump."
+                )
+            prev_siren = siren_int
+            if (
+                siren in orgs_sirens
+                and siren not in seen
+                and row.get("etablissementSiege") == "true"
+                # Force-included SIRENs keep their siège row regardless of NAF/état.
+                and (
+                    siren in FORCE_INCLUDE_SIRENE
+                    or row.get("etatAdministratifEtablissement") == "A"
+                )
+            ):
+                rows.append(row)
+                seen.add(siren)
+            if siren_int > max_target:
+                passed_range = True
+                break
+    finally:
+        # Closes the HTTP response when we exit early.
+        lines.close()
+
+    logger.info(
+        "SIRENE stream %s with %d rows", "passed range" if passed_range else "ended", len(rows)
+    )
+    if len(rows) <= 30000:
+        raise RuntimeError("Could not stream a complete SIRENE dump: %d rows" % len(rows))
 
-    return len(rows)
+    return rows
 
 
 def dump_groupements_memberships():
@@ -1,15 +1,48 @@
 import json
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from sentry_sdk.crons import monitor
 
 from broker import register_task
 
-from .db import historize_table
+from .db import TableNotInSnapshot, export_snapshot, get_db, historize_table
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+HISTORIZE_CONCURRENCY = 4
+
+HISTORIZED_TABLES = {
+    # The website reads monthly snapshots of these two tables (`WHERE history_month = ...`)
+    "st_organizations": "snapshot",
+    "data_rcpnt_stats": "snapshot",
+    # The others change little from one month to the next: only record the changes
+    "st_services": "delta",
+    "st_organizations_to_services": "delta",
+    "st_organizations_to_operators": "delta",
+    "st_operators": "delta",
+    "st_services_to_operators": "delta",
+}
+
+
+def historize(table_name: str, mode: str, snapshot: str):
+    """Historize a table on its own connection, and time it"""
+    start = time.perf_counter()
+    try:
+        counts = historize_table(table_name, mode=mode, snapshot=snapshot)
+    except TableNotInSnapshot:
+        # Swapped in after the snapshot was exported (like data_rcpnt_stats by its full
+        # rebuild): read the table as it is now
+        logger.warning(f"{table_name} was replaced after the snapshot, historizing it as is")
+        counts = historize_table(table_name, mode=mode)
+    if mode == "snapshot" and counts["rows"] == 0:
+        raise Exception(f"Historized no row of {table_name}")
+    duration = time.perf_counter() - start
+    logger.info(f"Historized {table_name} ({mode}) in {duration:.1f}s: {counts}")
+    return {**counts, "duration": round(duration, 1)}
+
 
 @register_task(name="historize.run", time_limit=600_000)
 @monitor(
@@ -24,14 +57,23 @@ logging.basicConfig(level=logging.INFO)
     },
 )
 def run():
-    historize_table("st_organizations")
-    historize_table("st_services")
-    historize_table("st_organizations_to_services")
-    historize_table("st_organizations_to_operators")
-    historize_table("st_operators")
-    historize_table("st_services_to_operators")
-    historize_table("data_rcpnt_stats")
-    return "ok"
+    # The tables are independent, so they are historized in parallel, each on its own
+    # connection. They all read the snapshot exported here, so that they reflect the
+    # same moment even if a sync writes to them meanwhile.
+    with get_db() as db:
+        with db.cursor() as cur:
+            snapshot = export_snapshot(cur)
+
+        with ThreadPoolExecutor(max_workers=HISTORIZE_CONCURRENCY) as executor:
+            futures = {
+                table_name: executor.submit(historize, table_name, mode, snapshot)
+                for table_name, mode in HISTORIZED_TABLES.items()
+            }
+            report = {table_name: future.result() for table_name, future in futures.items()}
+
+        # The snapshot only needs to stay exported until every table has imported it
+        db.rollback()
+    return report
 
 
 if __name__ == "__main__":
@@ -1,15 +1,28 @@
 import json
-import socket
+import logging
 import unicodedata
 from collections import Counter
-from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from threading import Lock
 from typing import Iterable
 from urllib.parse import urlparse
 
+import dns.exception
+import dns.resolver
 import maxminddb
 from cachetools import TTLCache, cached
 
+logger = logging.getLogger(__name__)
+
+# Answers of the default dnspython resolver (used by all DNS lookups, through
+# dns.resolver.resolve) are cached by each process for their TTL, including negative
+# answers (NXDOMAIN and no answer, for the TTL of their SOA). Many orgs share the same
+# email providers, whose records are then only resolved once.
+DNS_CACHE_SIZE = 100_000
+try:
+    dns.resolver.get_default_resolver().cache = dns.resolver.LRUCache(DNS_CACHE_SIZE)
+except dns.resolver.NoResolverConfiguration:
+    logger.warning("No DNS resolver configuration, DNS lookups won't work")
+
 
 def is_safe_url(url: str) -> bool:
     if not url:
@@ -35,6 +48,41 @@ def chunkify(lst, chunk_size):
     return [lst[i : i + chunk_size] for i in range(0, len(lst), chunk_size)]
 
 
+class JsonArrayWriter:
+    """
+    Write a JSON array to a text file one item at a time, so that the whole list never
+    has to be in memory. The output is the same as json.dump's with the same arguments.
+    """
+
+    def __init__(self, f, indent=None, separators=None, **kwargs):
+        self.f = f
+        self.indent = indent
+        self.kwargs = {"indent": indent, "separators": separators, **kwargs}
+        if indent is None:
+            self.item_separator = (separators or (", ", ": "))[0]
+        else:
+            self.item_separator = (separators or (",", ": "))[0] + "\n"
+        self.count = 0
+
+    def write(self, item):
+        text = json.dumps(item, **self.kwargs)
+        if self.indent is not None:
+            # Items are one level deep in the array
+            pad = " " * self.indent if isinstance(self.indent, int) else self.indent
+            text = pad + text.replace("\n", "\n" + pad)
+        self.f.write(
+            ("[" if self.indent is None else "[\n") if self.count == 0 else self.item_separator
+        )
+        self.f.write(text)
+        self.count += 1
+
+    def close(self):
+        if self.count == 0:
+            self.f.write("[]")
+        else:
+            self.f.write("]" if self.indent is None else "\n]")
+
+
 def iter_insee_communes():
     with open("dumps/insee_communes.json") as f:
         data = json.load(f)
@@ -121,20 +169,19 @@ def geoip_countries_by_hostname(hostname) -> tuple[list[str], list[str]]:
         return None, None
 
 
-def resolve_hostname(hostname) -> list[str]:
-    """Returns all the IPs for a hostname"""
-    return socket.gethostbyname_ex(hostname)[2]
+def resolve_hostname(hostname, timeout=10) -> list[str]:
+    """Returns all the IPv4 addresses for a hostname"""
+    answer = dns.resolver.resolve(hostname, "A", lifetime=timeout)
+    return [record.address for record in answer]
 
 
 def resolve_with_timeout(hostname, timeout=10) -> list[str]:
     """Returns all the IPs for a hostname with a timeout"""
-    with ThreadPoolExecutor(max_workers=1) as executor:
-        future = executor.submit(resolve_hostname, hostname)
-        try:
-            return future.result(timeout=timeout)
-        except TimeoutError as e:
-            raise TimeoutError(
-                f"DNS resolution for {hostname} timed out after {timeout} seconds"
-            ) from e
-        except socket.gaierror as e:
-            raise ConnectionError(f"Failed to resolve hostname {hostname}: {e}") from e
+    try:
+        return resolve_hostname(hostname, timeout=timeout)
+    except dns.resolver.LifetimeTimeout as e:
+        raise TimeoutError(
+            f"DNS resolution for {hostname} timed out after {timeout} seconds"
+        ) from e
+    except dns.exception.DNSException as e:
+        raise ConnectionError(f"Failed to resolve hostname {hostname}: {e}") from e
@@ -0,0 +1,102 @@
+import hashlib
+import logging
+import resource
+import time
+from contextlib import contextmanager
+from functools import cache
+from pathlib import Path
+
+import sentry_sdk
+
+from .db import get_sync_checkpoint, save_sync_checkpoint
+
+logger = logging.getLogger(__name__)
+
+
+def get_max_rss_mb() -> float:
+    """Peak resident memory of the process so far, in MB (ru_maxrss is in KB on Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@contextmanager
+def stage(name: str, report: list | None = None):
+    """Measure a pipeline stage: wall time, CPU time, peak RSS and record counts.
+
+    The stage is recorded as a Sentry span (when a transaction is running) and logged
+    when it ends. The caller sets counts on the yielded dict, e.g. `s["orgs"] = len(orgs)`.
+    If `report` is given, the stage metrics are appended to it.
+    """
+    counts = {}
+    max_rss_before = get_max_rss_mb()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    with sentry_sdk.start_span(op="pipeline.stage", name=name) as span:
+        try:
+            yield counts
+        finally:
+            max_rss = get_max_rss_mb()
+            metrics = {
+                "stage": name,
+                "wall_s": round(time.perf_counter() - wall_start, 2),
+                "cpu_s": round(time.process_time() - cpu_start, 2),
+                "max_rss_mb": round(max_rss),
+                # ru_maxrss is a high-water mark: it only grows when this stage went
+                # above the peak of the previous ones
+                "max_rss_growth_mb": round(max_rss - max_rss_before),
+                **counts,
+            }
+            for key, value in metrics.items():
+                span.set_data(key, value)
+            logger.info(
+                "Stage %s: %.1fs wall, %.1fs CPU, %d MB peak RSS (+%d MB)%s",
+                name,
+                metrics["wall_s"],
+                metrics["cpu_s"],
+                metrics["max_rss_mb"],
+                metrics["max_rss_growth_mb"],
+                "".join(f", {key}={value}" for key, value in counts.items()),
+                extra={"pipeline_stage": metrics},
+            )
+            if report is not None:
+                report.append(metrics)
+
+
+@cache
+def get_code_version() -> str:
+    """Hash of the source of the tasks, so that checkpoints don't outlive a code change"""
+    sha = hashlib.sha256()
+    for path in sorted(Path(__file__).parent.glob("*.py")):
+        sha.update(path.read_bytes())
+    return sha.hexdigest()
+
+
+def hash_inputs(files=(), values=()) -> str:
+    """Hash the content of input files and other input values, along with the code version"""
+    sha = hashlib.sha256(get_code_version().encode())
+    for path in files:
+        sha.update(str(path).encode())
+        with open(path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                sha.update(chunk)
+    for value in values:
+        sha.update(repr(value).encode())
+    return sha.hexdigest()
+
+
+def checkpointed(name: str, input_hash: str | None, compute, force: bool = False):
+    """
+    Run a stage, or reuse its output if it was already computed from the same inputs.
+
+    The output of `compute` must be JSON serializable. Without an `input_hash` (when the
+    inputs can't be identified), the stage always runs. Returns (output, reused).
+    """
+    if input_hash and not force:
+        found, output = get_sync_checkpoint(name, input_hash)
+        if found:
+            logger.info("Stage %s: inputs unchanged, reusing its checkpoint", name)
+            return output, True
+
+    output = compute()
+    if input_hash:
+        save_sync_checkpoint(name, input_hash, output)
+    return output, False
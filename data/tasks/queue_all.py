@@ -5,9 +5,11 @@ Run with: python -m tasks.queue_all
 
 from .check_dns import queue_all as queue_all_dns
 from .check_website import queue_all as queue_all_website
+from .db import prune_data_checks_log
 
 
 def main():
+    prune_data_checks_log()
     queue_all_website()
     queue_all_dns()
 
@@ -1,19 +1,33 @@
 import csv
+import gzip
+import hashlib
+import io
 import json
 import logging
 import os
 import re
+import sys
 from collections import defaultdict
 
+import sentry_sdk
 from sentry_sdk.crons import monitor
 
 from broker import register_task
 
-from .conformance import Issues, get_rcpnt_conformance, validate_conformance
+from .conformance import (
+    Issues,
+    bitmask_to_issues,
+    bitmask_to_refs,
+    get_rcpnt_conformance_masks,
+    issues_to_bitmask,
+    validate_conformance_masks,
+)
 from .db import (
-    get_all_data_checks,
-    get_data_checks_by_siret,
+    get_org_data_checks,
+    get_sync_checkpoint,
     init_db,
+    iter_data_checks_by_siret,
+    save_sync_checkpoint,
     update_rcpnt_stats,
 )
 from .defs import (
@@ -36,10 +50,12 @@ from .dumps import (
     dump_perimetre_epci,
     dump_service_usages,
     dump_services,
+    get_sirene_stock_version,
     reset_dila_issues,
     upload_file_to_data_gouv,
 )
 from .lib import (
+    JsonArrayWriter,
     duplicates,
     get_communes_population_by_insee,
     is_safe_url,
@@ -53,6 +69,7 @@ from .lib import (
     iter_sirene,
     normalize,
 )
+from .pipeline import checkpointed, hash_inputs, stage
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -70,70 +87,173 @@ logging.basicConfig(level=logging.INFO)
         "recovery_threshold": 3,
     },
 )
-def run():
-    """Main data sync workflow"""
+def run(force: bool = False):
+    """
+    Main data sync workflow.
+
+    Stages whose inputs didn't change since the previous run reuse its checkpoint,
+    unless `force` is set.
+    """
 
     logger.info(
         "Starting data sync workflow for %s",
         "production" if os.getenv("PRODUCTION") == "1" else "dev",
     )
 
-    # Create the "dumps/" directory if it doesn't exist
-    os.makedirs("dumps", exist_ok=True)
-    init_db()
-    reset_dila_issues()
-
-    dump_insee_communes()
-    dump_insee_departements()
-    dump_insee_regions()
-    dump_insee_population()
-    dump_dila()
-    dump_perimetre_epci()
-    dump_groupements_memberships()
-    dump_services()
-    dump_service_usages()
-    dump_operators()
-    dump_adherents()
-
-    communes = list_communes()
+    # Each stage is timed and recorded as a span of this transaction
+    report = []
+    with sentry_sdk.start_transaction(op="task", name="sync.run"):
+        # Create the "dumps/" directory if it doesn't exist
+        os.makedirs("dumps", exist_ok=True)
+        init_db()
+        reset_dila_issues()
+
+        with stage("dumps", report):
+            dump_insee_communes()
+            dump_insee_departements()
+            dump_insee_regions()
+            dump_insee_population()
+            dump_dila()
+            dump_perimetre_epci()
+            dump_groupements_memberships()
+            dump_services()
+            dump_service_usages()
+            dump_operators()
+            dump_adherents()
+
+        # Building the orgs from the dumps (SIRENE streaming and DILA matching
+        # included) is the expensive part, and its inputs rarely change
+        organizations_hash = get_organizations_inputs_hash()
+        with stage("organizations", report) as s:
+            output, s["reused"] = checkpointed(
+                "organizations",
+                organizations_hash,
+                lambda: build_organizations(report),
+                force=force,
+            )
+            orgs = output["orgs"]
+            s["orgs"] = len(orgs)
+            if s["reused"]:
+                # Restore the DILA issues found while building the orgs
+                with open("dumps/dila_issues.csv", "w") as f:
+                    f.write(output["dila_issues"])
+
+        with stage("conformance", report):
+            associate_conformance_to_orgs(orgs)
+
+        # Update data issues statistics
+        with stage("stats", report):
+            update_rcpnt_stats(orgs)
+
+        with stage("create_new_dumps", report) as s:
+            s["orgs"], uploads = create_new_dumps(orgs)
+
+        with stage("uploads", report) as s:
+            s["files"] = sum(
+                upload_if_changed(resource_id, filename, force=force)
+                for resource_id, filename in uploads.items()
+            )
+
+    return report
+
+
+# Dumps read while building the orgs, in addition to the SIRENE extract
+ORGANIZATIONS_INPUT_DUMPS = [
+    "dumps/insee_communes.json",
+    "dumps/insee_departements.json",
+    "dumps/insee_regions.json",
+    "dumps/insee_population.json",
+    "dumps/dila.json",
+    "dumps/perimetre_epci.json",
+    "dumps/operators.json",
+    "dumps/adherents.json",
+]
+
+
+def get_organizations_inputs_hash():
+    """Identify the inputs of build_organizations, or None if the SIRENE stock can't be"""
+    sirene_version, _ = get_sirene_stock_version()
+    if not sirene_version:
+        return None
+    return hash_inputs(files=ORGANIZATIONS_INPUT_DUMPS, values=[sirene_version])
+
+
+def build_organizations(report: list):
+    """Build the list of orgs from the dumps, with their SIRET, DILA data and operators"""
+
+    with stage("list_communes", report) as s:
+        communes = list_communes()
+        s["communes"] = len(communes)
 
     logger.info("Count of communes from INSEE: %d", len(communes))
 
-    associate_epci_to_communes(communes)
+    with stage("associate_epci_to_communes", report):
+        associate_epci_to_communes(communes)
 
     communes = filter_invalid_communes(communes)
 
     # "nature_juridique": "CC",
     # "mode_financ": "FPU",
-    epcis = list_epcis()
+    with stage("list_epcis", report) as s:
+        epcis = list_epcis()
+        s["epcis"] = len(epcis)
 
-    departements = list_departements()
+    with stage("list_departements", report) as s:
+        departements = list_departements()
+        s["departements"] = len(departements)
 
-    regions = list_regions()
+    with stage("list_regions", report) as s:
+        regions = list_regions()
+        s["regions"] = len(regions)
 
     orgs = regions + departements + epcis + communes
 
-    sirene_row_count = dump_filtered_sirene(orgs)
+    with stage("dump_filtered_sirene", report) as s:
+        sirene_row_count = dump_filtered_sirene(orgs)
+        s["sirene_rows"] = sirene_row_count
 
     logger.info("Dumped filtered sirene: %s rows", sirene_row_count)
 
-    associate_siret_to_organizations(orgs)
+    with stage("associate_siret_to_organizations", report) as s:
+        associate_siret_to_organizations(orgs)
+
+        # Remove orgs with no SIRET (warning emitted in the method above)
+        orgs = [x for x in orgs if x.get("siret")]
+        s["orgs"] = len(orgs)
 
-    # Remove orgs with no SIRET (warning emitted in the method above)
-    orgs = [x for x in orgs if x.get("siret")]
+    with stage("associate_dila_to_organizations", report):
+        associate_dila_to_organizations(orgs)
 
-    associate_dila_to_organizations(orgs)
+    with stage("associate_operators_to_orgs", report):
+        associate_operators_to_orgs(orgs)
 
-    associate_operators_to_orgs(orgs)
+    with stage("compute_slug_for_communes", report):
+        compute_slug_for_communes(orgs)
 
-    compute_slug_for_communes(orgs)
+    with open("dumps/dila_issues.csv") as f:
+        dila_issues = f.read()
 
-    associate_conformance_to_orgs(orgs)
+    return {"orgs": orgs, "dila_issues": dila_issues}
 
-    # Update data issues statistics
-    update_rcpnt_stats(orgs)
 
-    create_new_dumps(orgs)
+def upload_if_changed(resource_id: str, filename: str, force: bool = False) -> bool:
+    """
+    Upload a gzipped file to data.gouv.fr, unless the same content was already uploaded
+    to that resource. Returns whether it was uploaded.
+    """
+    # Hash the uncompressed content: the gzip header holds the file's mtime
+    with gzip.open(filename, "rb") as f:
+        content_hash = hashlib.file_digest(f, "sha256").hexdigest()
+
+    checkpoint_stage = f"upload_{resource_id}"
+    if not force and get_sync_checkpoint(checkpoint_stage, content_hash)[0]:
+        logger.info("%s is unchanged since its last upload, skipping it", filename)
+        return False
+
+    if not upload_file_to_data_gouv(resource_id, filename):
+        return False
+    save_sync_checkpoint(checkpoint_stage, content_hash)
+    return True
 
 
 def list_communes():
@@ -436,15 +556,21 @@ def associate_operators_to_orgs(orgs: list):
         for dep in operator.get("departements", []):
             operators_by_departement[dep].append(operator_id)
 
-    # Build adherent index: (siret, operator_id) pairs from the adherents dataset
-    adherent_pairs = set()
+    # Build adherent index: which operators each SIRET is an adherent of
+    adherent_operators_by_siret = defaultdict(set)
     for row in iter_adherents():
         siret = row.get("organisation_siret")
         operator_id = str(row.get("operateur_id", ""))
-        if siret and operator_id:
-            adherent_pairs.add((siret, operator_id))
+        if siret and operator_id in operators:
+            adherent_operators_by_siret[siret].add(operator_id)
 
-    logger.info("Loaded %d adherent pairs", len(adherent_pairs))
+    logger.info(
+        "Loaded %d adherent pairs",
+        sum(len(x) for x in adherent_operators_by_siret.values()),
+    )
+
+    # Keep adherent-only operators in the order of the operators dataset
+    operator_rank = {operator_id: rank for rank, operator_id in enumerate(operators)}
 
     for org in orgs:
         org["_st_operators"] = []
@@ -464,12 +590,12 @@ def associate_operators_to_orgs(orgs: list):
             operator_links[operator_id] = {"is_perimetre": True, "is_adherent": False}
 
         # Adherent: operators this org is an adherent of
-        for operator_id in operators:
-            if (siret, operator_id) in adherent_pairs:
-                if operator_id in operator_links:
-                    operator_links[operator_id]["is_adherent"] = True
-                else:
-                    operator_links[operator_id] = {"is_perimetre": False, "is_adherent": True}
+        adherent_operators = adherent_operators_by_siret.get(siret, ())
+        for operator_id in sorted(adherent_operators, key=operator_rank.__getitem__):
+            if operator_id in operator_links:
+                operator_links[operator_id]["is_adherent"] = True
+            else:
+                operator_links[operator_id] = {"is_perimetre": False, "is_adherent": True}
 
         org["_st_operators"] = [{"id": op_id, **flags} for op_id, flags in operator_links.items()]
 
@@ -518,21 +644,28 @@ def compute_slug_for_communes(orgs: list):
 def associate_conformance_to_orgs(orgs: list):
     """Associate conformance to orgs"""
 
-    all_data_checks = get_all_data_checks()
-
-    logger.info("Fetched data_checks for %d orgs", len(all_data_checks))
-
-    for org in orgs:
-        org["_st_conformite"] = [
-            str(issue)
-            for issue in validate_conformance(
-                org.get("_st_email") or "", org.get("_st_website") or ""
-            )
-        ]
-
-        # Add the issues added in asynchronous checks
-        issues, website_metadata, email_metadata, min_dt = get_data_checks_by_siret(
-            all_data_checks, org["_st_conformite"], org["siret"]
+    conformance_masks = validate_conformance_masks(
+        [org.get("_st_email") or "" for org in orgs],
+        [org.get("_st_website") or "" for org in orgs],
+    )
+    for org, conformance_mask in zip(orgs, conformance_masks, strict=True):
+        org["_st_conformite"] = [str(issue) for issue in bitmask_to_issues(conformance_mask)]
+
+    # Add the issues added in asynchronous checks, merging the orgs in SIRET order with
+    # the checks aggregated (in the same order) by the database
+    data_checks = iter_data_checks_by_siret()
+    siret_checks = next(data_checks, None)
+    checked_orgs_count = 0
+    for org in sorted(orgs, key=lambda org: org["siret"] or ""):
+        while siret_checks is not None and siret_checks["siret"] < (org["siret"] or ""):
+            siret_checks = next(data_checks, None)
+        org_checks = None
+        if siret_checks is not None and siret_checks["siret"] == org["siret"]:
+            org_checks = siret_checks
+            checked_orgs_count += 1
+
+        issues, website_metadata, email_metadata, min_dt = get_org_data_checks(
+            org_checks, org["_st_conformite"]
         )
 
         org["_st_conformite"].extend([str(x) for x in issues.keys()])
@@ -541,9 +674,17 @@ def associate_conformance_to_orgs(orgs: list):
         org["_st_website_metadata"] = website_metadata
         org["_st_email_metadata"] = email_metadata
 
-        # Add the RCPNT conformance info
-        org["_st_rcpnt"] = get_rcpnt_conformance(org["_st_conformite"])
+    data_checks.close()
+    logger.info("Fetched data_checks for %d orgs", checked_orgs_count)
 
+    # Add the RCPNT conformance info
+    rcpnt_masks = get_rcpnt_conformance_masks(
+        [issues_to_bitmask(org["_st_conformite"]) for org in orgs]
+    )
+    for org, rcpnt_mask in zip(orgs, rcpnt_masks, strict=True):
+        org["_st_rcpnt"] = bitmask_to_refs(rcpnt_mask)
+
+    for org in orgs:
         # Report issues to Dila
         if "EMAIL_MALFORMED" in org["_st_conformite"]:
             add_dila_issue(
@@ -582,8 +723,8 @@ def associate_conformance_to_orgs(orgs: list):
         logger.info(f" - {issue}: {sum(1 for org in orgs if issue.name in org['_st_conformite'])}")
 
 
-def create_new_dumps(orgs: list):
-    """Create new dumps of the orgs"""
+def iter_dump_rows(orgs: list):
+    """Build the rows of organizations.json from the orgs, skipping duplicate SIRETs"""
 
     # Build siren→siret lookup for resolving epci_siret
     siren_to_siret = {}
@@ -598,9 +739,7 @@ def create_new_dumps(orgs: list):
         if org.get("type") == "region" and org.get("siret") and org.get("insee_reg"):
             reg_to_siret[org["insee_reg"]] = org["siret"]
 
-    # Dump as JSON
     seen_sirets = set()
-    final_data = []
     for org in orgs:
         if org.get("siret") and org.get("siret") in seen_sirets:
             logger.warning(
@@ -654,112 +793,156 @@ def create_new_dumps(orgs: list):
         # Is it currently active in Suite territoriale ?
         st_active = False
 
-        final_data.append(
-            {
-                "type": org["type"],
-                "siret": org["siret"],
-                "siren": org["siren"],
-                "slug": slug,
-                "name": org["name"],
-                "insee_com": org.get("insee_com"),
-                "insee_dep": org.get("insee_dep"),
-                "insee_reg": org["insee_reg"],
-                "rcpnt": sorted(org["_st_rcpnt"]) if org.get("_st_rcpnt") else None,
-                "issues": org.get("_st_conformite"),
-                "issues_last_checked": str(org.get("_st_conformite_checks_dt") or ""),
-                "email_official": email_official,
-                "email_metadata": org.get("_st_email_metadata") or None,
-                "website_url": website_official,
-                "website_domain": website_domain,
-                "email_domain": email_domain,
-                "website_tld": website_tld,
-                "website_metadata": org.get("_st_website_metadata") or None,
-                "email_tld": email_tld,
-                "zipcode": org.get("zipcode") or None,
-                "phone": phone,
-                "population": org["population"],
-                "epci_population": org.get("epci_population"),
-                "epci_name": org.get("_st_epci", {}).get("raison_sociale") or None,
-                "epci_siren": org.get("_st_epci", {}).get("siren") or None,
-                "epci_siret": siren_to_siret.get(org.get("_st_epci", {}).get("siren", "")) or None,
-                "dep_siret": dep_to_siret.get(org.get("insee_dep", "")) or None,
-                "region_siret": reg_to_siret.get(org.get("insee_reg", "")) or None,
-                "service_public_url": url_sp,
-                "service_public_id": id_sp,
-                "st_eligible": st_eligible,
-                "st_active": st_active,
-                "operators": org.get("_st_operators")
-                or [],  # list of {id, is_perimetre, is_adherent}
-            }
-        )
+        yield {
+            "type": org["type"],
+            "siret": org["siret"],
+            "siren": org["siren"],
+            "slug": slug,
+            "name": org["name"],
+            "insee_com": org.get("insee_com"),
+            "insee_dep": org.get("insee_dep"),
+            "insee_reg": org["insee_reg"],
+            "rcpnt": sorted(org["_st_rcpnt"]) if org.get("_st_rcpnt") else None,
+            "issues": org.get("_st_conformite"),
+            "issues_last_checked": str(org.get("_st_conformite_checks_dt") or ""),
+            "email_official": email_official,
+            "email_metadata": org.get("_st_email_metadata") or None,
+            "website_url": website_official,
+            "website_domain": website_domain,
+            "email_domain": email_domain,
+            "website_tld": website_tld,
+            "website_metadata": org.get("_st_website_metadata") or None,
+            "email_tld": email_tld,
+            "zipcode": org.get("zipcode") or None,
+            "phone": phone,
+            "population": org["population"],
+            "epci_population": org.get("epci_population"),
+            "epci_name": org.get("_st_epci", {}).get("raison_sociale") or None,
+            "epci_siren": org.get("_st_epci", {}).get("siren") or None,
+            "epci_siret": siren_to_siret.get(org.get("_st_epci", {}).get("siren", "")) or None,
+            "dep_siret": dep_to_siret.get(org.get("insee_dep", "")) or None,
+            "region_siret": reg_to_siret.get(org.get("insee_reg", "")) or None,
+            "service_public_url": url_sp,
+            "service_public_id": id_sp,
+            "st_eligible": st_eligible,
+            "st_active": st_active,
+            "operators": org.get("_st_operators") or [],  # list of {id, is_perimetre, is_adherent}
+        }
+
+
+def get_dpnt_row(row: dict) -> dict:
+    """Build a row of the public dpnt-quotidien files from a row of organizations.json"""
+    return {
+        "type": row["type"],
+        "siret": row["siret"],
+        "siren": row["siren"],
+        "libelle": row["name"],
+        "population": row["population"],
+        "code_insee": row["insee_com"],
+        "code_postal": row["zipcode"],
+        "epci_libelle": row["epci_name"],
+        "epci_siren": row["epci_siren"],
+        "epci_siret": row["epci_siret"],
+        "epci_population": row["epci_population"],
+        "departement_code_insee": row["insee_dep"],
+        "departement_siret": row["dep_siret"],
+        "region_code_insee": row["insee_reg"],
+        "region_siret": row["region_siret"],
+        "adresse_messagerie": row["email_official"],
+        "site_internet": row["website_url"],
+        "telephone": row["phone"],
+        "rpnt": row["rcpnt"],
+        "service_public_url": row["service_public_url"],
+    }
 
-    logger.info("Dumping %d orgs", len(final_data))
-
-    if os.getenv("PRODUCTION") == "1" and len(final_data) < 30000:
-        raise Exception("Not enough orgs to dump for production: %d" % len(final_data))
-
-    with open("dumps/organizations.json", "w") as f:
-        json.dump(final_data, f, ensure_ascii=False, indent=4)
-
-    # Dump public files for data.gouv.fr
-    full_dpnt = []
-    for row in final_data:
-        full_dpnt.append(
-            {
-                "type": row["type"],
-                "siret": row["siret"],
-                "siren": row["siren"],
-                "libelle": row["name"],
-                "population": row["population"],
-                "code_insee": row["insee_com"],
-                "code_postal": row["zipcode"],
-                "epci_libelle": row["epci_name"],
-                "epci_siren": row["epci_siren"],
-                "epci_siret": row["epci_siret"],
-                "epci_population": row["epci_population"],
-                "departement_code_insee": row["insee_dep"],
-                "departement_siret": row["dep_siret"],
-                "region_code_insee": row["insee_reg"],
-                "region_siret": row["region_siret"],
-                "adresse_messagerie": row["email_official"],
-                "site_internet": row["website_url"],
-                "telephone": row["phone"],
-                "rpnt": row["rcpnt"],
-                "service_public_url": row["service_public_url"],
-            }
-        )
-    with open("dumps/dpnt-quotidien.json", "w") as f:
-        json.dump(full_dpnt, f, separators=(",", ":"))
-    os.system("rm -rf dumps/dpnt-quotidien.json.gz && gzip -9 -f dumps/dpnt-quotidien.json")
-
-    # Make sure file is at least 2MB
-    if (
-        os.getenv("PRODUCTION") == "1"
-        and os.path.getsize("dumps/dpnt-quotidien.json.gz") < 2 * 1024 * 1024
-    ):
-        raise Exception("File is too small")
 
-    upload_file_to_data_gouv(
-        "fd73a12f-572c-4b04-89e9-91cc8c6ebcb3", "dumps/dpnt-quotidien.json.gz"
+def open_gzip_text(path: str, **kwargs):
+    """
+    Open a gzip file to write text in it. No timestamp is written in its header, so that
+    the same content always gives the same file.
+    """
+    return io.TextIOWrapper(
+        gzip.GzipFile(path, "wb", compresslevel=9, mtime=0), encoding="utf-8", **kwargs
     )
 
-    # Write the same data in a zipped CSV
-    with open("dumps/dpnt-quotidien.csv", "w") as f:
-        writer = csv.DictWriter(f, fieldnames=full_dpnt[0].keys(), delimiter=";")
-        writer.writeheader()
-        for row in full_dpnt:
-            row["rpnt"] = ",".join(row["rpnt"]) if row.get("rpnt") else ""
-            writer.writerow(row)
-    os.system("rm -rf dumps/dpnt-quotidien.csv.gz && cd dumps && gzip -9 -f dpnt-quotidien.csv")
-
-    # Make sure file is at least 2MB
-    if (
-        os.getenv("PRODUCTION") == "1"
-        and os.path.getsize("dumps/dpnt-quotidien.csv.gz") < 2 * 1024 * 1024
+
+# Sanity checks of the dumps before they replace the previous ones in production
+PRODUCTION_DUMPS_MIN_ORGS = 30000
+PRODUCTION_DUMPS_MIN_SIZE = 2 * 1024 * 1024  # of each public file, in bytes
+
+
+def create_new_dumps(orgs: list):
+    """
+    Create new dumps of the orgs: organizations.json, and the public dpnt-quotidien
+    files for data.gouv.fr (as gzipped JSON and CSV). They are written in a single pass
+    over the orgs, to temporary files that only replace the previous dumps once checked.
+
+    Returns the count of orgs dumped, and the files to upload by data.gouv.fr resource.
+    """
+
+    paths = [
+        "dumps/organizations.json",
+        "dumps/dpnt-quotidien.json.gz",
+        "dumps/dpnt-quotidien.csv.gz",
+    ]
+    try:
+        count = write_new_dumps(orgs)
+
+        if os.getenv("PRODUCTION") == "1":
+            if count < PRODUCTION_DUMPS_MIN_ORGS:
+                raise Exception("Not enough orgs to dump for production: %d" % count)
+            # Make sure public files are big enough
+            for path in paths[1:]:
+                if os.path.getsize(path + ".tmp") < PRODUCTION_DUMPS_MIN_SIZE:
+                    raise Exception(f"File is too small: {path}")
+
+        for path in paths:
+            os.replace(path + ".tmp", path)
+    finally:
+        # Left over when the dumps failed or were rejected
+        for path in paths:
+            if os.path.exists(path + ".tmp"):
+                os.remove(path + ".tmp")
+
+    # Uploaded to data.gouv.fr by the caller, once all the files are written
+    uploads = {
+        "fd73a12f-572c-4b04-89e9-91cc8c6ebcb3": "dumps/dpnt-quotidien.json.gz",
+        "551a41a5-4ac7-40df-99cb-930aedb3c3ac": "dumps/dpnt-quotidien.csv.gz",
+    }
+    return count, uploads
+
+
+def write_new_dumps(orgs: list) -> int:
+    """Write the dumps of create_new_dumps to their .tmp files. Returns the count of orgs."""
+    with (
+        open("dumps/organizations.json.tmp", "w") as organizations_file,
+        open_gzip_text("dumps/dpnt-quotidien.json.gz.tmp") as dpnt_json_file,
+        open_gzip_text("dumps/dpnt-quotidien.csv.gz.tmp", newline="") as dpnt_csv_file,
     ):
-        raise Exception("File is too small")
+        organizations_writer = JsonArrayWriter(organizations_file, ensure_ascii=False, indent=4)
+        dpnt_json_writer = JsonArrayWriter(dpnt_json_file, separators=(",", ":"))
+        dpnt_csv_writer = None
+
+        for row in iter_dump_rows(orgs):
+            organizations_writer.write(row)
+
+            dpnt_row = get_dpnt_row(row)
+            dpnt_json_writer.write(dpnt_row)
+
+            # Write the same data in the CSV
+            if dpnt_csv_writer is None:
+                dpnt_csv_writer = csv.DictWriter(
+                    dpnt_csv_file, fieldnames=dpnt_row.keys(), delimiter=";"
+                )
+                dpnt_csv_writer.writeheader()
+            dpnt_row["rpnt"] = ",".join(dpnt_row["rpnt"]) if dpnt_row.get("rpnt") else ""
+            dpnt_csv_writer.writerow(dpnt_row)
+
+        organizations_writer.close()
+        dpnt_json_writer.close()
 
-    upload_file_to_data_gouv("551a41a5-4ac7-40df-99cb-930aedb3c3ac", "dumps/dpnt-quotidien.csv.gz")
+    logger.info("Dumped %d orgs", organizations_writer.count)
+    return organizations_writer.count
 
 
 @register_task(name="sync.debug_sentry")
@@ -768,4 +951,5 @@ def debug_sentry():
 
 
 if __name__ == "__main__":
-    run()
+    ret = run(force="--force" in sys.argv)
+    logger.info(json.dumps(ret, indent=2))
@@ -1,15 +1,132 @@
 import json
 import logging
+import random
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
 
 import pytz
+import requests
 from pygrister.api import GristApi
+from requests.packages.urllib3.exceptions import NewConnectionError
+
+from .lib import chunkify
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
+GRIST_BATCH_SIZE = 500
+GRIST_CONCURRENCY = 4
+GRIST_MAX_ATTEMPTS = 5
+# A sync deleting more memberships than this ratio of the existing ones (beyond the
+# first MEMBERSHIPS_DELETIONS_ALLOWED) is aborted: the BANATIC dump is likely broken
+MEMBERSHIPS_MAX_DELETED_RATIO = 0.1
+MEMBERSHIPS_DELETIONS_ALLOWED = 50
+
+
+def failed_before_sending(e: Exception) -> bool:
+    """Whether a request failed while connecting, so the server never received it"""
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    # requests wraps urllib3's MaxRetryError, whose reason is the underlying error
+    reason = getattr(e.args[0], "reason", None) if e.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def is_transient_error(e: Exception, method: str) -> bool:
+    """
+    Whether a failed Grist call is worth retrying.
+
+    update_records and delete_rows are idempotent, so they are retried on any network
+    error, 429 or 5xx. add_records is not: after a timeout, a dropped connection or a 5xx,
+    Grist may already have added the records, and sending them again would duplicate
+    them. It's only retried when Grist surely didn't get it (429, or a failure to
+    connect); otherwise the sync fails, and its next run lists the records again and only
+    adds the missing ones.
+    """
+    if isinstance(e, requests.HTTPError):
+        if e.response is None:
+            return False
+        if e.response.status_code == 429:
+            return True
+        return method != "add_records" and e.response.status_code >= 500
+    if method == "add_records":
+        return failed_before_sending(e)
+    return isinstance(e, (requests.ConnectionError, requests.Timeout))
+
+
+def write_grist_batch(method: str, table_id: str, batch: list):
+    """Send one batch to Grist, retrying transient failures with exponential backoff"""
+    for attempt in range(GRIST_MAX_ATTEMPTS):
+        # GristApi keeps per-call state, so each thread needs its own client.
+        grist = GristApi()
+        try:
+            if method == "delete_rows":
+                status, _ = grist.delete_rows(table_id=table_id, rows=batch)
+            else:
+                # update_records pops the "id" of the records it is given: send
+                # copies so that a retry still has them.
+                status, _ = getattr(grist, method)(
+                    table_id=table_id, records=[dict(record) for record in batch]
+                )
+        except requests.RequestException as e:
+            if not is_transient_error(e, method) or attempt == GRIST_MAX_ATTEMPTS - 1:
+                raise
+            delay = 2**attempt + random.random()  # noqa: S311
+            logger.warning(f"Grist {method} on {table_id} failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        if status != 200:
+            raise Exception(f"Failed to {method} on {table_id}: {status}")
+        return len(batch)
+
+
+def write_grist_records(
+    method: str,
+    table_id: str,
+    records: list,
+    label: str,
+    batch_size: int = GRIST_BATCH_SIZE,
+    concurrency: int = GRIST_CONCURRENCY,
+):
+    """
+    Write records to a Grist table with add_records, update_records or delete_rows
+    (records are then row ids), in batches of `batch_size` with up to `concurrency`
+    batches in flight.
+    """
+    if len(records) == 0:
+        return
+
+    start = time.monotonic()
+    done_count = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(write_grist_batch, method, table_id, batch)
+            for batch in chunkify(records, batch_size)
+        ]
+        for future in as_completed(futures):
+            done_count += future.result()
+            logger.info(f"{done_count}/{len(records)} {label}")
+
+    duration = time.monotonic() - start
+    logger.info(
+        f"{len(records)} {label} in {duration:.1f}s ({len(records) / max(duration, 0.001):.0f}/s)"
+    )
+
+
+def same_value(a, b):
+    """Compare a value from our dumps to a Grist cell, where empty text cells are "" """
+    return (a if a is not None else "") == (b if b is not None else "")
+
+
+def changed_fields(fields: dict, record: dict) -> dict:
+    """Return the fields whose value differs from the existing Grist record"""
+    return {key: value for key, value in fields.items() if not same_value(value, record.get(key))}
+
+
 def update_repertoire_epcis():
     """
     Update the Repertoire EPCIs
@@ -23,20 +140,14 @@ def update_repertoire_epcis():
     )
     if records[0] != 200:
         raise Exception("Failed to fetch EPCIs")
-    epcis_repertoire = records[1]
+    epcis_repertoire_by_siren = {epci["Numero_SIREN"]: epci for epci in records[1]}
 
+    now = datetime.now(pytz.timezone("Europe/Paris")).strftime("%Y-%m-%d %H:%M:%S")
     to_update = []
     to_create = []
 
     for uptodate_epci in uptodate_epcis:
-        existing_epci = next(
-            (
-                epci_repertoire
-                for epci_repertoire in epcis_repertoire
-                if epci_repertoire["Numero_SIREN"] == uptodate_epci["siren"]
-            ),
-            None,
-        )
+        existing_epci = epcis_repertoire_by_siren.get(uptodate_epci["siren"])
 
         if existing_epci is None:
             to_create.append(
@@ -47,33 +158,26 @@ def update_repertoire_epcis():
                     "Code_INSEE_region": f"r{uptodate_epci['insee_reg']}",
                     "Code_INSEE_departement": uptodate_epci["insee_dep"],
                     "Numero_SIREN": uptodate_epci["siren"],
-                    "Derniere_mise_a_jour_script_": datetime.now(
-                        pytz.timezone("Europe/Paris")
-                    ).strftime("%Y-%m-%d %H:%M:%S"),
+                    "Derniere_mise_a_jour_script_": now,
                 }
             )
         else:
-            to_update.append(
-                {
-                    "id": existing_epci["id"],
-                    "Code_INSEE_geographique": uptodate_epci["siren"],
-                    "Libelle": uptodate_epci["name"],
-                    "Code_INSEE_region": f"r{uptodate_epci['insee_reg']}",
-                    "Code_INSEE_departement": uptodate_epci["insee_dep"],
-                    "PMUN_2025": uptodate_epci["population"],
-                    "Derniere_mise_a_jour_script_": datetime.now(
-                        pytz.timezone("Europe/Paris")
-                    ).strftime("%Y-%m-%d %H:%M:%S"),
-                }
-            )
+            fields = {
+                "Code_INSEE_geographique": uptodate_epci["siren"],
+                "Libelle": uptodate_epci["name"],
+                "Code_INSEE_region": f"r{uptodate_epci['insee_reg']}",
+                "Code_INSEE_departement": uptodate_epci["insee_dep"],
+                "PMUN_2025": uptodate_epci["population"],
+            }
+            if changed_fields(fields, existing_epci):
+                to_update.append(
+                    {"id": existing_epci["id"], **fields, "Derniere_mise_a_jour_script_": now}
+                )
 
-    if len(to_create) > 0:
-        grist.add_records(table_id="COLLECTIVITES", records=to_create)
-        logger.info(f"{len(to_create)} EPCIs created")
+    write_grist_records("add_records", "COLLECTIVITES", to_create, "EPCIs created")
+    write_grist_records("update_records", "COLLECTIVITES", to_update, "EPCIs updated")
 
-    if len(to_update) > 0:
-        grist.update_records(table_id="COLLECTIVITES", records=to_update)
-        logger.info(f"{len(to_update)} EPCIs updated")
+    logger.info(f"{len(uptodate_epcis) - len(to_create) - len(to_update)} EPCIs unchanged")
 
 
 def update_repertoire_communes():
@@ -87,75 +191,46 @@ def update_repertoire_communes():
     records = grist.list_records(table_id="COLLECTIVITES", filter={"Typologie": ["Commune"]})
     if records[0] != 200:
         raise Exception("Failed to fetch cities")
-    communes_repertoire = records[1]
+    communes_repertoire_by_insee = {
+        commune["Code_INSEE_geographique"]: commune for commune in records[1]
+    }
 
+    now = datetime.now(pytz.timezone("Europe/Paris")).strftime("%Y-%m-%d %H:%M:%S")
     to_update = []
     to_create = []
 
     for uptodate_commune in uptodate_communes:
-        existing_commune = next(
-            (
-                commune_repertoire
-                for commune_repertoire in communes_repertoire
-                if commune_repertoire["Code_INSEE_geographique"] == uptodate_commune["insee_com"]
-            ),
-            None,
-        )
+        existing_commune = communes_repertoire_by_insee.get(uptodate_commune["insee_com"])
+
+        fields = {
+            "Code_INSEE_geographique": uptodate_commune["insee_com"],
+            "Typologie": "Commune",
+            "Libelle": uptodate_commune["name"],
+            "Code_INSEE_region": f"r{uptodate_commune['insee_reg']}",
+            "Code_INSEE_departement": uptodate_commune["insee_dep"],
+            "Code_INSEE_commune": uptodate_commune["insee_com"],
+            "Numero_SIREN": uptodate_commune["siren"],
+            "Numero_SIREN_EPCI": uptodate_commune["epci_siren"],
+            "Code_postal": uptodate_commune["zipcode"],
+            "Courriel": uptodate_commune["email_official"],
+            "Site_web": uptodate_commune["website_url"],
+            "PMUN_2025": uptodate_commune["population"],
+        }
 
         if existing_commune is None:
-            to_create.append(
-                {
-                    "Code_INSEE_geographique": uptodate_commune["insee_com"],
-                    "Typologie": "Commune",
-                    "Libelle": uptodate_commune["name"],
-                    "Code_INSEE_region": f"r{uptodate_commune['insee_reg']}",
-                    "Code_INSEE_departement": uptodate_commune["insee_dep"],
-                    "Code_INSEE_commune": uptodate_commune["insee_com"],
-                    "Numero_SIREN": uptodate_commune["siren"],
-                    "Numero_SIREN_EPCI": uptodate_commune["epci_siren"],
-                    "Code_postal": uptodate_commune["zipcode"],
-                    "Courriel": uptodate_commune["email_official"],
-                    "Site_web": uptodate_commune["website_url"],
-                    "PMUN_2025": uptodate_commune["population"],
-                    "Derniere_mise_a_jour_script_": datetime.now(
-                        pytz.timezone("Europe/Paris")
-                    ).strftime("%Y-%m-%d %H:%M:%S"),
-                }
-            )
-        else:
+            to_create.append({**fields, "Derniere_mise_a_jour_script_": now})
+        # Grist bulk updates need the same fields on every record, so a changed
+        # record is sent whole.
+        elif changed_fields(fields, existing_commune):
             to_update.append(
-                {
-                    "id": existing_commune["id"],
-                    "Code_INSEE_geographique": uptodate_commune["insee_com"],
-                    "Typologie": "Commune",
-                    "Libelle": uptodate_commune["name"],
-                    "Code_INSEE_region": f"r{uptodate_commune['insee_reg']}",
-                    "Code_INSEE_departement": uptodate_commune["insee_dep"],
-                    "Code_INSEE_commune": uptodate_commune["insee_com"],
-                    "Numero_SIREN": uptodate_commune["siren"],
-                    "Numero_SIREN_EPCI": uptodate_commune["epci_siren"],
-                    "Code_postal": uptodate_commune["zipcode"],
-                    "Courriel": uptodate_commune["email_official"],
-                    "Site_web": uptodate_commune["website_url"],
-                    "PMUN_2025": uptodate_commune["population"],
-                    "Derniere_mise_a_jour_script_": datetime.now(
-                        pytz.timezone("Europe/Paris")
-                    ).strftime("%Y-%m-%d %H:%M:%S"),
-                }
+                {"id": existing_commune["id"], **fields, "Derniere_mise_a_jour_script_": now}
             )
 
-    if len(to_create) > 0:
-        grist.add_records(table_id="COLLECTIVITES", records=to_create)
-        logger.info(f"{len(to_create)} communes created")
+    write_grist_records("add_records", "COLLECTIVITES", to_create, "communes created")
+
+    logger.info(f"{len(uptodate_communes) - len(to_create) - len(to_update)} communes unchanged")
 
-    if len(to_update) > 0:
-        logger.info(f"{len(to_update)} communes to update")
-        updated_count = 0
-        for i in range(0, len(to_update), 500):
-            to_update_batch = to_update[i : i + 500]
-            grist.update_records(table_id="COLLECTIVITES", records=to_update_batch)
-            updated_count += len(to_update_batch)
-            logger.info(f"{updated_count} communes updated")
+    write_grist_records("update_records", "COLLECTIVITES", to_update, "communes updated")
 
 
 def update_repertoire_orga_members():
@@ -168,6 +243,10 @@ def update_repertoire_orga_members():
     memberships_from_banatic = json.load(
         open("dumps/groupements_memberships.json", encoding="utf-8")
     )
+    if len(memberships_from_banatic) == 0:
+        logger.warning("No memberships in the BANATIC dump, skipping their sync")
+        return
+
     grist = GristApi()
     organisations_records = grist.list_records(table_id="ORGANISATIONS")
     if organisations_records[0] != 200:
@@ -188,57 +267,67 @@ def update_repertoire_orga_members():
     organisations_with_banatic_name = [
         orga for orga in repertoire_organisations if orga["Libelle_BANATIC"] != ""
     ]
-    memberships_to_create = []
 
+    members_sirens_by_banatic_siren = defaultdict(set)
+    for member in memberships_from_banatic:
+        members_sirens_by_banatic_siren[str(member["N° SIREN"])].add(str(member["Siren membre"]))
+
+    collectivite_id_by_siren = {}
+    for collectivite in repertoire_collectivites:
+        collectivite_id_by_siren.setdefault(collectivite["Numero_SIREN"], collectivite["id"])
+
+    # (organisation id, collectivite id) pairs, as they should be vs. as they are
+    expected_memberships = set()
     for organisation in organisations_with_banatic_name:
-        members = [
-            member
-            for member in memberships_from_banatic
-            if str(member["N° SIREN"]) == organisation["SIREN"]
-        ]
+        for member_siren in members_sirens_by_banatic_siren.get(organisation["SIREN"], ()):
+            collectivite_id = collectivite_id_by_siren.get(member_siren)
+            if collectivite_id is not None:
+                expected_memberships.add((organisation["id"], collectivite_id))
 
-        for member in members:
-            collectivite = next(
-                (
-                    collectivite
-                    for collectivite in repertoire_collectivites
-                    if collectivite["Numero_SIREN"] == str(member["Siren membre"])
-                ),
-                None,
-            )
-            if collectivite is None:
-                continue
-            existing_membership = next(
-                (
-                    membership
-                    for membership in repertoire_memberships
-                    if membership["Organisation"] == organisation["id"]
-                    and membership["Membre_collectivite_"] == collectivite["id"]
-                ),
-                None,
-            )
-            if existing_membership is not None:
-                continue
-            memberships_to_create.append(
-                {
-                    "Organisation": organisation["id"],
-                    "Membre_collectivite_": collectivite["id"],
-                    "Derniere_mise_a_jour_script_": datetime.now(
-                        pytz.timezone("Europe/Paris")
-                    ).strftime("%Y-%m-%d %H:%M:%S"),
-                }
-            )
+    existing_memberships = defaultdict(list)
+    for membership in repertoire_memberships:
+        existing_memberships[
+            (membership["Organisation"], membership["Membre_collectivite_"])
+        ].append(membership)
 
-    if len(memberships_to_create) > 0:
-        logger.info(f"{len(memberships_to_create)} memberships to create")
-        created_count = 0
-        for i in range(0, len(memberships_to_create), 500):
-            memberships_to_create_batch = memberships_to_create[i : i + 500]
-            grist.add_records(
-                table_id="MEMBRES_ORGANISATIONS", records=memberships_to_create_batch
-            )
-            created_count += len(memberships_to_create_batch)
-            logger.info(f"{created_count} memberships created")
+    now = datetime.now(pytz.timezone("Europe/Paris")).strftime("%Y-%m-%d %H:%M:%S")
+    memberships_to_create = [
+        {
+            "Organisation": organisation_id,
+            "Membre_collectivite_": collectivite_id,
+            "Derniere_mise_a_jour_script_": now,
+        }
+        for organisation_id, collectivite_id in sorted(
+            expected_memberships - existing_memberships.keys()
+        )
+    ]
+
+    # Only delete memberships this script manages: those of organisations with a
+    # BANATIC name that it created itself, not the ones added by hand.
+    banatic_organisation_ids = {orga["id"] for orga in organisations_with_banatic_name}
+    memberships_to_delete = [
+        membership["id"]
+        for pair, memberships in existing_memberships.items()
+        for membership in memberships
+        if pair not in expected_memberships
+        and pair[0] in banatic_organisation_ids
+        and membership.get("Derniere_mise_a_jour_script_")
+    ]
+    max_deletions = max(
+        MEMBERSHIPS_DELETIONS_ALLOWED, MEMBERSHIPS_MAX_DELETED_RATIO * len(repertoire_memberships)
+    )
+    if len(memberships_to_delete) > max_deletions:
+        raise Exception(
+            f"Refusing to delete {len(memberships_to_delete)} of the "
+            f"{len(repertoire_memberships)} memberships, check the BANATIC dump"
+        )
+
+    write_grist_records(
+        "add_records", "MEMBRES_ORGANISATIONS", memberships_to_create, "memberships created"
+    )
+    write_grist_records(
+        "delete_rows", "MEMBRES_ORGANISATIONS", memberships_to_delete, "memberships deleted"
+    )
 
 
 if __name__ == "__main__":
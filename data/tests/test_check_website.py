@@ -1,3 +1,5 @@
+import datetime
+import io
 import os
 import socket
 import ssl
@@ -8,10 +10,15 @@ from http.server import BaseHTTPRequestHandler, HTTPServer
 import pytest
 import requests
 
+from ..tasks import check_website as check_website_module
 from ..tasks.check_website import (
     check_website,
+    get_dead_host_issues,
+    get_headers,
+    get_session,
     is_allowed_redirect_domain,
     is_trusted_redirect_chain,
+    url_origin,
 )
 from ..tasks.conformance import Issues
 
@@ -50,11 +57,28 @@ class LocalhostHandler(BaseHTTPRequestHandler):
             self.send_header("Location", "/gouv_redirect")
             self.end_headers()
 
+        elif self.path == "/set_cookie":
+            self.send_response(200)
+            self.send_header("Set-Cookie", "consent=yes; Path=/")
+            self.end_headers()
+
+        elif self.path == "/echo_cookie":
+            self.send_response(200 if self.headers.get("Cookie") is None else 403)
+            self.end_headers()
+
         elif self.path == "/slow":
             time.sleep(1)
             self.send_response(200)
             self.end_headers()
 
+        elif self.path == "/slow_body":
+            # Announces a big body, that is never sent
+            self.send_response(200)
+            self.send_header("Content-Length", str(10 * 1024 * 1024))
+            self.end_headers()
+            self.wfile.flush()
+            time.sleep(2)
+
         elif self.path == "/timeout":
             time.sleep(15)
             self.send_response(200)
@@ -190,14 +214,14 @@ def patch_requests_for_local_certs(monkeypatch, ssl_certs):
 
     _, cert_path = ssl_certs
 
-    original_get = requests.get
+    original_request = requests.Session.request
 
-    def patched_get(url, *args, **kwargs):
+    def patched_request(self, method, url, *args, **kwargs):
         if "localhost:8443" in url:
             kwargs["verify"] = cert_path
-        return original_get(url, *args, **kwargs)
+        return original_request(self, method, url, *args, **kwargs)
 
-    monkeypatch.setattr(requests, "get", patched_get)
+    monkeypatch.setattr(requests.Session, "request", patched_request)
 
 
 def test_ok(http_server):
@@ -341,6 +365,76 @@ def test_down_website():
     assert Issues.WEBSITE_DOWN in issues
 
 
+def test_get_headers_skips_body(http_server):
+    """Probes return as soon as the headers are in, without waiting for the body"""
+    start = time.monotonic()
+    response = get_headers("http://localhost:8080/slow_body", timeout=1)
+    assert response.status_code == 200
+    assert time.monotonic() - start < 1
+
+
+def test_get_headers_stores_no_cookies(http_server):
+    """Cookies set by a site are neither kept nor sent back"""
+    assert get_headers("http://localhost:8080/set_cookie").status_code == 200
+    assert len(get_session().cookies) == 0
+    assert get_headers("http://localhost:8080/echo_cookie").status_code == 200
+
+
+def test_get_headers_circuit_breaker(http_server):
+    """Once an origin timed out, the next requests to it fail right away"""
+    timed_out_origins = set()
+    with pytest.raises(requests.exceptions.Timeout):
+        get_headers("http://localhost:8080/slow", timeout=0.5, timed_out_origins=timed_out_origins)
+    assert timed_out_origins == {("http", "localhost:8080")}
+
+    start = time.monotonic()
+    with pytest.raises(requests.exceptions.Timeout):
+        get_headers("http://localhost:8080/", timeout=0.5, timed_out_origins=timed_out_origins)
+    assert time.monotonic() - start < 0.1
+
+
+def test_check_website_http_timeout_https_ok(monkeypatch):
+    """An HTTPS site whose port 80 is firewalled isn't considered down"""
+
+    def get(self, url, **kwargs):
+        if url.startswith("http://"):
+            raise requests.exceptions.ConnectTimeout(
+                request=requests.Request("GET", url).prepare()
+            )
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response.raw = io.BytesIO(b"")
+        return response
+
+    monkeypatch.setattr(requests.Session, "get", get)
+    timed_out_origins = set()
+    issues = check_website("https://www.maville.fr/", timed_out_origins=timed_out_origins)
+    assert set(issues) == {Issues.WEBSITE_HTTP_REDIRECT, Issues.WEBSITE_HTTP_NOWWW}
+    assert timed_out_origins == {("http", "www.maville.fr"), ("http", "maville.fr")}
+    assert url_origin("https://www.maville.fr/") not in timed_out_origins
+
+
+def test_get_dead_host_issues(monkeypatch):
+    last_checks = {
+        "down": {"issues": ["WEBSITE_DOWN"], "details": ["HTTPS access failed: timeout"]},
+        "up": {"issues": ["WEBSITE_HTTP_NOWWW"], "details": ["HTTP without www failed"]},
+        "renamed": {"issues": ["WEBSITE_DOWN", "WEBSITE_GONE"], "details": ["x", "y"]},
+    }
+    monkeypatch.setattr(
+        check_website_module, "get_data_check", lambda siret, check_type: last_checks.get(siret)
+    )
+    dead_host = {"first_failure_dt": datetime.datetime(2025, 3, 2, tzinfo=datetime.timezone.utc)}
+    down_since = {Issues.WEBSITE_DOWN: "Website unreachable since 2025-03-02"}
+
+    assert get_dead_host_issues("down", dead_host) == {
+        Issues.WEBSITE_DOWN: "HTTPS access failed: timeout"
+    }
+    assert get_dead_host_issues("up", dead_host) == down_since
+    assert get_dead_host_issues("renamed", dead_host) == down_since
+    assert get_dead_host_issues("unknown", dead_host) == down_since
+
+
 def test_local_ssl(
     http_server, https_server, patch_requests_for_local_certs, force_all_to_localhost
 ):
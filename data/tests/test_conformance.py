@@ -1,9 +1,15 @@
 from ..tasks.conformance import (
+    ISSUE_BITS,
     Issues,
     RcpntRefs,
+    bitmask_to_issues,
+    bitmask_to_refs,
     data_checks_doable,
     get_rcpnt_conformance,
+    get_rcpnt_conformance_masks,
+    issues_to_bitmask,
     validate_conformance,
+    validate_conformance_masks,
 )
 
 
@@ -268,3 +274,68 @@ def test_get_rcpnt_conformance():
         "2.7",
         "2.8",
     }
+
+
+def test_issues_bitmask():
+    """Every issue has its own bit, and the encoding round-trips"""
+    assert set(ISSUE_BITS) == {issue.name for issue in Issues}
+    assert max(ISSUE_BITS.values()) < 2**31  # Fits in an INTEGER column
+
+    issues = [Issues.WEBSITE_SSL, Issues.DNS_DOWN, Issues.EMAIL_MISSING]
+    bitmask = issues_to_bitmask(issues)
+    assert bitmask_to_issues(bitmask) == [
+        Issues.EMAIL_MISSING,
+        Issues.WEBSITE_SSL,
+        Issues.DNS_DOWN,
+    ]
+    assert issues_to_bitmask([str(issue) for issue in issues]) == bitmask
+    assert issues_to_bitmask([]) == 0
+
+
+def test_get_rcpnt_conformance_masks():
+    """The batch API gives the refs of the rule-by-rule implementation, in order"""
+    cases = [
+        ([], RcpntRefs),
+        ([Issues.EMAIL_MISSING, Issues.WEBSITE_MISSING], set()),
+        ([Issues.WEBSITE_MISSING, Issues.DNS_DOWN], {"2.1", "2.2"}),
+        (
+            [Issues.WEBSITE_MISSING],
+            {"2.1", "2.2", "2.4", "2.5", "2.6", "2.7", "2.8", "2.a", "2.aa"},
+        ),
+        (
+            [Issues.WEBSITE_DOMAIN_EXTENSION, Issues.EMAIL_DOMAIN_EXTENSION],
+            {"1.1", "1.3", "1.4", "1.5", "1.6", "1.7", "1.8"}
+            | {"2.1", "2.2", "2.4", "2.5", "2.6", "2.7", "2.8"},
+        ),
+        (
+            [
+                Issues.WEBSITE_DECLARED_HTTP,
+                Issues.EMAIL_DOMAIN_MISMATCH,
+                Issues.EMAIL_DOMAIN_GENERIC,
+                Issues.WEBSITE_DOMAIN_EXTENSION,
+            ],
+            {"1.1", "1.3", "1.4", "1.5", "1.6", "1.7", "2.1", "2.4", "2.5", "2.6", "2.7", "2.8"},
+        ),
+        (
+            [Issues.WEBSITE_SSL, Issues.WEBSITE_HTTP_REDIRECT, Issues.DNS_DMARC_WEAK],
+            {"1.1", "1.2", "1.3", "1.6", "1.8"}
+            | {"2.1", "2.2", "2.3", "2.4", "2.5", "2.6", "2.8", "2.a"},
+        ),
+        ([], RcpntRefs),
+        (["UNKNOWN_ISSUE"], RcpntRefs),
+    ]
+    masks = get_rcpnt_conformance_masks([issues_to_bitmask(issues) for issues, _ in cases])
+    assert [bitmask_to_refs(mask) for mask in masks] == [refs for _, refs in cases]
+    assert [get_rcpnt_conformance(issues) for issues, _ in cases] == [refs for _, refs in cases]
+
+
+def test_validate_conformance_masks():
+    """The batch validator gives the same issues as validate_conformance, in order"""
+    emails = ["contact@maville.fr", "", "maville@wanadoo.fr", "contact@maville.fr", "@"]
+    websites = ["https://www.maville.fr", "", "http://maville.com", "https://autre.fr", "x"]
+    masks = validate_conformance_masks(emails, websites)
+    assert [bitmask_to_issues(mask) for mask in masks] == [
+        validate_conformance(email, website)
+        for email, website in zip(emails, websites, strict=True)
+    ]
+    assert masks[0] == 0
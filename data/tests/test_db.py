@@ -0,0 +1,195 @@
+import datetime
+import os
+from unittest.mock import MagicMock
+
+import pytest
+
+from ..tasks import db as tasks_db
+from ..tasks.conformance import Issues, RcpntRefs
+from ..tasks.db import (
+    calculate_rcpnt_stats,
+    flush_data_checks_log,
+    get_check_content_hash,
+    get_db,
+    get_org_data_checks,
+    get_population_range,
+    init_db,
+    log_data_check,
+    upsert_issues,
+)
+
+
+def _commune(siret, population, rcpnt, epci="200000001", dep="01", reg="84"):
+    return {
+        "type": "commune",
+        "siret": siret,
+        "population": population,
+        "insee_dep": dep,
+        "insee_reg": reg,
+        "_st_epci": {"siren": epci} if epci else {},
+        "_st_rcpnt": set(rcpnt),
+    }
+
+
+def test_get_population_range():
+    assert get_population_range(0) == "0-200"
+    assert get_population_range(200) == "0-200"
+    assert get_population_range(3000) == "2000-3500"
+    assert get_population_range(250000) == "100000-"
+
+
+def test_calculate_rcpnt_stats():
+    orgs = [
+        _commune("21000000100011", 100, RcpntRefs),
+        _commune("21000000200011", 300, {"1.1", "1.2"}),
+        _commune("21000000300011", 1500, {"1.1"}, epci="200000002", dep="02", reg="32"),
+        _commune("21000000400011", 50, set(), epci=None),
+        {"type": "epci", "siret": "20000000100011", "population": 1950, "_st_rcpnt": {"2.1"}},
+    ]
+
+    stats = {(x[0], x[1], x[2]): x[3:] for x in calculate_rcpnt_stats(orgs)}
+
+    # 22 refs for: global, global-epci, 2 EPCIs, 2 deps, 2 regs, 3 population ranges
+    assert len(stats) == 22 * 11
+
+    valid, total, valid_pop, total_pop, sample_valid, sample_invalid = stats[
+        ("global", None, "1.1")
+    ]
+    assert (valid, total, valid_pop, total_pop) == (3, 4, 1900, 1950)
+    assert set(sample_valid) == {"21000000100011", "21000000200011", "21000000300011"}
+    assert sample_invalid == ["21000000400011"]
+
+    valid, total, valid_pop, total_pop, sample_valid, sample_invalid = stats[
+        ("epci", "200000001", "1.2")
+    ]
+    assert (valid, total, valid_pop, total_pop) == (2, 2, 400, 400)
+    assert sample_invalid == []
+
+    assert stats[("global-epci", None, "2.1")][:4] == (1, 1, 1950, 1950)
+    assert stats[("dep", "02", "aa")][:4] == (0, 1, 0, 1500)
+    assert stats[("pop", "1000-2000", "1.1")][:4] == (1, 1, 1500, 1500)
+
+    # Invalid samples are picked among the orgs with the fewest other issues
+    many = [_commune(f"21{i:012d}", 10, set(list(RcpntRefs - {"aa"})[:i])) for i in range(20)]
+    sample_invalid = {(x[0], x[1], x[2]): x for x in calculate_rcpnt_stats(many)}[
+        ("global", None, "aa")
+    ][8]
+    assert all(int(siret[2:]) >= 8 for siret in sample_invalid)
+
+
+def test_calculate_rcpnt_stats_only_groups():
+    orgs = [
+        _commune("21000000100011", 100, RcpntRefs),
+        _commune("21000000300011", 1500, {"1.1"}, epci="200000002", dep="02", reg="32"),
+    ]
+
+    stats = calculate_rcpnt_stats(orgs, only_groups={("global", "global"), ("dep", "02")})
+
+    assert {(x[0], x[1]) for x in stats} == {("global", None), ("dep", "02")}
+    assert len(stats) == 2 * 22
+
+
+def test_get_org_data_checks():
+    dt = datetime.datetime(2025, 1, 1, 12, 0, 0, 123, tzinfo=datetime.timezone.utc)
+    siret_checks = {
+        "siret": "21010001600012",
+        "types": ["dns", "website"],
+        "issues": {"DNS_SPF_MISSING": "No SPF", "WEBSITE_SSL": "Bad certificate"},
+        "website_metadata": None,
+        "email_metadata": {"mx": ["mx.example.com"]},
+        "dt": dt,
+    }
+    issues, website_metadata, email_metadata, min_dt = get_org_data_checks(siret_checks, [])
+    assert issues == siret_checks["issues"]
+    assert website_metadata == {}
+    assert email_metadata == {"mx": ["mx.example.com"]}
+    assert min_dt == dt.replace(microsecond=0)
+
+    # Checks that could not be run (no email here) are not waited for
+    siret_checks["types"] = ["website"]
+    issues, _, _, _ = get_org_data_checks(siret_checks, ["EMAIL_MISSING"])
+    assert "IN_PROGRESS" not in issues
+
+    issues, _, _, _ = get_org_data_checks(siret_checks, [])
+    assert issues == {"IN_PROGRESS": "Checks still in progress: dns"}
+
+    issues, _, _, _ = get_org_data_checks(None, ["EMAIL_MISSING", "WEBSITE_MISSING"])
+    assert issues == {}
+
+
+def test_get_check_content_hash():
+    metadata = {"mx_ips": ["1.2.3.4", "5.6.7.8"], "mx_countries": ["FR", "DE"], "mx_tld": "fr"}
+    reordered = {"mx_tld": "fr", "mx_countries": ["DE", "FR"], "mx_ips": ["5.6.7.8", "1.2.3.4"]}
+    content_hash = get_check_content_hash(["DNS_DMARC_MISSING"], ["No DMARC"], metadata)
+    assert get_check_content_hash(["DNS_DMARC_MISSING"], ["No DMARC"], reordered) == content_hash
+    assert get_check_content_hash([], [], metadata) != content_hash
+    assert (
+        get_check_content_hash(["DNS_DMARC_MISSING"], ["No DMARC"], {**metadata, "mx_tld": "eu"})
+        != content_hash
+    )
+    # Other lists are ordered (e.g. MX by priority)
+    assert get_check_content_hash(
+        ["DNS_DMARC_MISSING"], ["No DMARC"], {**metadata, "mx": ["mx1.fr", "mx2.fr"]}
+    ) != get_check_content_hash(
+        ["DNS_DMARC_MISSING"], ["No DMARC"], {**metadata, "mx": ["mx2.fr", "mx1.fr"]}
+    )
+
+
+@pytest.mark.skipif(not os.getenv("DATABASE_URL"), reason="needs a database")
+def test_upsert_issues_keeps_dt_when_unchanged():
+    init_db()
+    siret = "00000000000000"
+    issues = {Issues.DNS_MX_OUTSIDE_EU: "MX outside of the EU"}
+
+    def get_dts():
+        with get_db() as db:
+            with db.cursor() as cur:
+                cur.execute(
+                    "SELECT c.dt, v.dt FROM data_checks c "
+                    "JOIN data_checks_verified v USING (siret, type) "
+                    "WHERE siret = %s AND type = 'dns'",
+                    (siret,),
+                )
+                return tuple(cur.fetchone())
+
+    try:
+        upsert_issues(siret, "dns", issues, {"mx_ips": ["1.1.1.1", "2.2.2.2"]})
+        changed_dt, verified_dt = get_dts()
+
+        upsert_issues(siret, "dns", issues, {"mx_ips": ["2.2.2.2", "1.1.1.1"]})
+        assert get_dts()[0] == changed_dt
+        assert get_dts()[1] > verified_dt
+
+        upsert_issues(siret, "dns", issues, {"mx_ips": ["3.3.3.3"]})
+        assert get_dts()[0] > changed_dt
+    finally:
+        with get_db() as db:
+            with db.cursor() as cur:
+                cur.execute("DELETE FROM data_checks WHERE siret = %s", (siret,))
+                cur.execute("DELETE FROM data_checks_verified WHERE siret = %s", (siret,))
+            db.commit()
+
+
+def test_flush_data_checks_log_keeps_rows_on_failure(monkeypatch):
+    def broken_db():
+        raise ConnectionError("database is down")
+
+    flush_data_checks_log()  # Rows buffered by other tests
+    monkeypatch.setenv("DATABASE_URL", "postgresql://localhost/down")
+    monkeypatch.setattr(tasks_db, "get_db", broken_db)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    log_data_check("00000000000001", "dns", [], now)
+    log_data_check("00000000000002", "website", ["WEBSITE_DOWN"], now)
+    flush_data_checks_log()  # Fails, but doesn't raise
+
+    # The rows are written by the next flush that works
+    written = []
+    monkeypatch.setattr(tasks_db, "get_db", MagicMock())
+    monkeypatch.setattr(
+        tasks_db, "execute_values", lambda cur, sql, rows, page_size: written.extend(rows)
+    )
+    flush_data_checks_log()
+    assert [row[:2] for row in written] == [
+        ("00000000000001", "dns"),
+        ("00000000000002", "website"),
+    ]
@@ -0,0 +1,173 @@
+import gzip
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+import requests
+
+from ..tasks import dumps
+from ..tasks.dumps import dump_filtered_sirene, iter_remote_gzip_lines
+
+LINES = [f"{i:09d},ligne {i},84.11Z" for i in range(20000)]
+PAYLOAD = gzip.compress("\n".join(LINES).encode("utf-8"))
+
+
+class TruncatingRangeHandler(BaseHTTPRequestHandler):
+    """Serves PAYLOAD, but cuts every response after `max_bytes` bytes."""
+
+    payload = PAYLOAD
+    max_bytes = len(PAYLOAD) // 3
+    declare_length = True
+
+    def do_GET(self):
+        payload = self.payload
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"].removeprefix("bytes=").rstrip("-"))
+            if start >= len(payload):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(payload)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(payload) - 1}/{len(payload)}")
+        else:
+            self.send_response(200)
+        if self.declare_length:
+            self.send_header("Content-Length", str(len(payload) - start))
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(payload[start : start + self.max_bytes])
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def gzip_server():
+    server = HTTPServer(("localhost", 0), TruncatingRangeHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_iter_remote_gzip_lines_resumes_after_truncation(gzip_server):
+    """A connection cut short is resumed with a Range request, without duplicates"""
+    url = f"http://localhost:{gzip_server.server_port}/sirene.csv.gz"
+    assert list(iter_remote_gzip_lines(url, chunk_size=1024)) == LINES
+
+
+def test_iter_remote_gzip_lines_resumes_after_clean_eof(gzip_server, monkeypatch):
+    """A stream that ends cleanly before the gzip trailer is also resumed"""
+    monkeypatch.setattr(TruncatingRangeHandler, "declare_length", False)
+    url = f"http://localhost:{gzip_server.server_port}/sirene.csv.gz"
+    assert list(iter_remote_gzip_lines(url, chunk_size=1024)) == LINES
+
+
+@pytest.mark.parametrize("declare_length", [True, False])
+def test_iter_remote_gzip_lines_resume_at_eof(gzip_server, monkeypatch, declare_length):
+    """A file missing its gzip trailer is complete once a resume at its length gets a 416"""
+    monkeypatch.setattr(TruncatingRangeHandler, "payload", PAYLOAD[:-8])
+    monkeypatch.setattr(TruncatingRangeHandler, "declare_length", declare_length)
+    url = f"http://localhost:{gzip_server.server_port}/sirene.csv.gz"
+    assert list(iter_remote_gzip_lines(url, chunk_size=1024)) == LINES
+
+
+def test_iter_remote_gzip_lines_gives_up(gzip_server):
+    url = f"http://localhost:{gzip_server.server_port}/sirene.csv.gz"
+    with pytest.raises(RuntimeError):
+        list(iter_remote_gzip_lines(url, max_resumes=1, chunk_size=1024))
+
+
+SIRENE_ROWS = {
+    "200000001": {"siren": "200000001", "denominationUniteLegale": "Stock actuel"},
+    "200000002": {"siren": "200000002", "denominationUniteLegale": "Stock actuel"},
+}
+
+
+@pytest.fixture
+def sirene_env(tmp_path, monkeypatch):
+    """Run dump_filtered_sirene in an empty dumps/ dir, with mocked data.gouv and DB"""
+    (tmp_path / "dumps").mkdir()
+    monkeypatch.chdir(tmp_path)
+
+    env = {"remote_version": '"etag-2"', "persisted_version": None, "extract": {}}
+    env["streamed"] = []
+    env["saved"] = []
+
+    def get_remote_version(url):
+        if isinstance(env["remote_version"], Exception):
+            raise env["remote_version"]
+        return env["remote_version"]
+
+    def get_sirene_extract(sirens, stock_version):
+        extract = env["extract"].get(stock_version, {})
+        return {siren: row for siren, row in extract.items() if siren in sirens}
+
+    def stream_filtered_sirene(url, sirens):
+        env["streamed"].append(sirens)
+        return [SIRENE_ROWS[siren] for siren in sorted(sirens)]
+
+    monkeypatch.setattr(dumps, "get_remote_version", get_remote_version)
+    monkeypatch.setattr(dumps, "get_sirene_extract_version", lambda: env["persisted_version"])
+    monkeypatch.setattr(dumps, "get_sirene_extract", get_sirene_extract)
+    monkeypatch.setattr(dumps, "save_sirene_extract", lambda *args: env["saved"].append(args[2]))
+    monkeypatch.setattr(dumps, "stream_filtered_sirene", stream_filtered_sirene)
+    return env
+
+
+ORGS = [{"siren": "200000001"}, {"siren": "200000002"}, {"siren": None}]
+EXTRACT_ROWS = [
+    {"siren": "200000001", "denominationUniteLegale": "Extrait"},
+    {"siren": "200000002", "denominationUniteLegale": "Extrait"},
+]
+
+
+def read_sirene_dump():
+    with open("dumps/sirene.json") as f:
+        return json.load(f)
+
+
+def test_dump_filtered_sirene_reuses_extract_of_same_stock(sirene_env):
+    sirene_env["extract"] = {'"etag-2"': {row["siren"]: row for row in EXTRACT_ROWS}}
+    assert dump_filtered_sirene(ORGS) == 2
+    assert read_sirene_dump() == EXTRACT_ROWS
+    assert sirene_env["streamed"] == []
+    assert sirene_env["saved"] == []
+
+
+def test_dump_filtered_sirene_refreshes_on_new_stock(sirene_env):
+    """An extract of an older stock, or missing a SIREN, is refreshed from the stream"""
+    sirene_env["extract"] = {
+        '"etag-1"': {row["siren"]: row for row in EXTRACT_ROWS},
+        '"etag-2"': {"200000001": EXTRACT_ROWS[0]},
+    }
+    assert dump_filtered_sirene(ORGS) == 2
+    assert read_sirene_dump() == list(SIRENE_ROWS.values())
+    assert sirene_env["streamed"] == [{"200000001", "200000002"}]
+    assert sirene_env["saved"] == ['"etag-2"']
+
+
+@pytest.mark.parametrize(
+    "remote_version", [requests.ConnectionError("data.gouv down"), None], ids=["error", "no_etag"]
+)
+def test_dump_filtered_sirene_falls_back_to_persisted_extract(sirene_env, remote_version):
+    sirene_env["remote_version"] = remote_version
+    sirene_env["persisted_version"] = '"etag-1"'
+    sirene_env["extract"] = {'"etag-1"': {row["siren"]: row for row in EXTRACT_ROWS}}
+    assert dump_filtered_sirene(ORGS) == 2
+    assert read_sirene_dump() == EXTRACT_ROWS
+    assert sirene_env["streamed"] == []
+
+
+def test_dump_filtered_sirene_unknown_stock_is_streamed_but_not_persisted(sirene_env):
+    sirene_env["remote_version"] = None
+    assert dump_filtered_sirene(ORGS) == 2
+    assert read_sirene_dump() == list(SIRENE_ROWS.values())
+    assert sirene_env["saved"] == []
@@ -1,4 +1,16 @@
-from tasks.lib import geoip_countries_by_hostname, geoip_country_by_ip
+import io
+import json
+from unittest.mock import patch
+
+import dns.resolver
+import pytest
+
+from tasks.lib import (
+    JsonArrayWriter,
+    geoip_countries_by_hostname,
+    geoip_country_by_ip,
+    resolve_with_timeout,
+)
 
 
 def test_geoip_country_by_ip():
@@ -11,3 +23,27 @@ def test_geoip_country_by_hostname():
     assert geoip_countries_by_hostname("elysee.fr")[1] == ["FR"]
     assert geoip_countries_by_hostname("whitehouse.gov")[1] == ["US"]
     assert geoip_countries_by_hostname("doesntexist.gouv.fr")[1] is None
+
+
+def test_resolve_with_timeout_errors():
+    with patch("dns.resolver.resolve", side_effect=dns.resolver.NXDOMAIN()):
+        with pytest.raises(ConnectionError):
+            resolve_with_timeout("doesntexist.gouv.fr")
+    with patch(
+        "dns.resolver.resolve", side_effect=dns.resolver.LifetimeTimeout(timeout=1.0, errors=[])
+    ):
+        with pytest.raises(TimeoutError):
+            resolve_with_timeout("slow.gouv.fr", timeout=1)
+
+
+def test_json_array_writer():
+    items = [{"nom": "Saint-Étienne", "rpnt": ["1.1", "2.1"], "site": None}, [], "x"]
+    for kwargs in [{}, {"separators": (",", ":")}, {"ensure_ascii": False, "indent": 4}]:
+        for data in [items, items[:1], []]:
+            f = io.StringIO()
+            writer = JsonArrayWriter(f, **kwargs)
+            for item in data:
+                writer.write(item)
+            writer.close()
+            assert f.getvalue() == json.dumps(data, **kwargs)
+            assert writer.count == len(data)
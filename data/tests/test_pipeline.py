@@ -0,0 +1,73 @@
+import logging
+
+import pytest
+
+from ..tasks import pipeline
+from ..tasks.pipeline import checkpointed, hash_inputs, stage
+
+
+def test_stage_reports_metrics(caplog):
+    report = []
+    with caplog.at_level(logging.INFO):
+        with stage("build", report) as s:
+            data = [bytes(1024) for _ in range(1000)]
+            s["rows"] = len(data)
+
+    assert len(report) == 1
+    metrics = report[0]
+    assert metrics["stage"] == "build"
+    assert metrics["rows"] == 1000
+    assert metrics["wall_s"] >= 0
+    assert metrics["cpu_s"] >= 0
+    assert metrics["max_rss_mb"] > 0
+    assert caplog.records[-1].pipeline_stage == metrics
+    assert "rows=1000" in caplog.records[-1].getMessage()
+
+
+def test_stage_reports_failures():
+    report = []
+    with pytest.raises(ValueError):
+        with stage("broken", report):
+            raise ValueError()
+    assert [m["stage"] for m in report] == ["broken"]
+
+
+def test_hash_inputs(tmp_path):
+    path = tmp_path / "dump.json"
+    path.write_text("[1, 2]")
+    first = hash_inputs(files=[path], values=["v1"])
+    assert hash_inputs(files=[path], values=["v1"]) == first
+    assert hash_inputs(files=[path], values=["v2"]) != first
+    path.write_text("[1, 2, 3]")
+    assert hash_inputs(files=[path], values=["v1"]) != first
+
+
+def test_checkpointed(monkeypatch):
+    checkpoints = {}
+    monkeypatch.setattr(
+        pipeline,
+        "get_sync_checkpoint",
+        lambda stage, input_hash: (
+            (True, checkpoints[stage][1])
+            if checkpoints.get(stage, (None,))[0] == input_hash
+            else (False, None)
+        ),
+    )
+    monkeypatch.setattr(
+        pipeline,
+        "save_sync_checkpoint",
+        lambda stage, input_hash, output=None: checkpoints.update({stage: (input_hash, output)}),
+    )
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {"orgs": [len(calls)]}
+
+    assert checkpointed("orgs", "a", compute) == ({"orgs": [1]}, False)
+    assert checkpointed("orgs", "a", compute) == ({"orgs": [1]}, True)
+    assert checkpointed("orgs", "a", compute, force=True) == ({"orgs": [2]}, False)
+    assert checkpointed("orgs", "b", compute) == ({"orgs": [3]}, False)
+    # Without an input hash, the stage always runs
+    assert checkpointed("orgs", None, compute) == ({"orgs": [4]}, False)
+    assert checkpoints["orgs"] == ("b", {"orgs": [3]})
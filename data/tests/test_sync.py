@@ -0,0 +1,194 @@
+import csv
+import gzip
+import json
+import os
+
+import pytest
+
+from ..tasks import sync
+from ..tasks.sync import create_new_dumps
+
+DUMP_PATHS = [
+    "dumps/organizations.json",
+    "dumps/dpnt-quotidien.json.gz",
+    "dumps/dpnt-quotidien.csv.gz",
+]
+
+
+def make_orgs():
+    return [
+        {
+            "type": "region",
+            "siret": "20005376700014",
+            "siren": "200053767",
+            "name": "Région Test",
+            "insee_reg": "84",
+            "population": 8000000,
+            "_st_conformite": ["WEBSITE_MISSING", "EMAIL_MISSING"],
+        },
+        {
+            "type": "epci",
+            "siret": "20006919300011",
+            "siren": "200069193",
+            "name": "CC Test",
+            "insee_reg": "84",
+            "population": 12000,
+            "_st_conformite": ["WEBSITE_MISSING", "EMAIL_MISSING"],
+        },
+        {
+            "type": "commune",
+            "siret": "21010001400017",
+            "siren": "210100014",
+            "name": "Ville",
+            "insee_com": "01001",
+            "insee_dep": "01",
+            "insee_reg": "84",
+            "zipcode": "01400",
+            "population": 800,
+            "_st_slug": "ville",
+            "_st_website": "https://www.ville.fr",
+            "_st_email": "mairie@ville.fr",
+            "_st_conformite": [],
+            "_st_rcpnt": {"2.1", "1.1"},
+            "_st_epci": {
+                "siren": "200069193",
+                "raison_sociale": "CC Test",
+                "total_pop_mun": "12 000",
+            },
+            "_st_dila": {
+                "id": "abc",
+                "telephone": [{"valeur": "04 00 00 00 00"}],
+                "url_service_public": "https://lannuaire.service-public.gouv.fr/abc",
+            },
+        },
+        # Same SIRET as the commune above: skipped
+        {
+            "type": "commune",
+            "siret": "21010001400017",
+            "siren": "210100014",
+            "name": "Doublon",
+            "insee_reg": "84",
+            "population": 1,
+            "_st_slug": "doublon",
+            "_st_conformite": ["WEBSITE_MISSING", "EMAIL_MISSING"],
+        },
+    ]
+
+
+def dpnt_row(**fields):
+    row = dict.fromkeys(
+        [
+            "type",
+            "siret",
+            "siren",
+            "libelle",
+            "population",
+            "code_insee",
+            "code_postal",
+            "epci_libelle",
+            "epci_siren",
+            "epci_siret",
+            "epci_population",
+            "departement_code_insee",
+            "departement_siret",
+            "region_code_insee",
+            "region_siret",
+            "adresse_messagerie",
+            "site_internet",
+            "telephone",
+            "rpnt",
+            "service_public_url",
+        ]
+    )
+    row.update(fields, region_code_insee="84", region_siret="20005376700014")
+    return row
+
+
+EXPECTED_DPNT_ROWS = [
+    dpnt_row(
+        type="region",
+        siret="20005376700014",
+        siren="200053767",
+        libelle="Région Test",
+        population=8000000,
+    ),
+    dpnt_row(
+        type="epci", siret="20006919300011", siren="200069193", libelle="CC Test", population=12000
+    ),
+    dpnt_row(
+        type="commune",
+        siret="21010001400017",
+        siren="210100014",
+        libelle="Ville",
+        population=800,
+        code_insee="01001",
+        code_postal="01400",
+        epci_libelle="CC Test",
+        epci_siren="200069193",
+        epci_siret="20006919300011",
+        epci_population=12000,
+        departement_code_insee="01",
+        adresse_messagerie="mairie@ville.fr",
+        site_internet="https://www.ville.fr",
+        telephone="04 00 00 00 00",
+        rpnt=["1.1", "2.1"],
+        service_public_url="https://lannuaire.service-public.gouv.fr/abc",
+    ),
+]
+
+
+@pytest.fixture
+def dumps_dir(tmp_path, monkeypatch):
+    """An empty working directory with the previous dumps in dumps/"""
+    (tmp_path / "dumps").mkdir()
+    monkeypatch.chdir(tmp_path)
+    for path in DUMP_PATHS:
+        with open(path, "w") as f:
+            f.write("previous")
+    return tmp_path / "dumps"
+
+
+def test_create_new_dumps(dumps_dir, monkeypatch):
+    monkeypatch.setenv("PRODUCTION", "1")
+    monkeypatch.setattr(sync, "PRODUCTION_DUMPS_MIN_ORGS", 3)
+    monkeypatch.setattr(sync, "PRODUCTION_DUMPS_MIN_SIZE", 100)
+
+    count, uploads = create_new_dumps(make_orgs())
+    assert count == 3
+    assert sorted(uploads.values()) == sorted(DUMP_PATHS[1:])
+    assert sorted(os.listdir(dumps_dir)) == sorted(os.path.basename(p) for p in DUMP_PATHS)
+
+    with open("dumps/organizations.json") as f:
+        rows = json.load(f)
+    assert [row["slug"] for row in rows] == ["region-84", "epci-200069193", "ville"]
+    assert [row["st_eligible"] for row in rows] == [False, True, True]
+    assert rows[2]["website_domain"] == "www.ville.fr"
+    assert rows[2]["issues"] == []
+
+    with gzip.open("dumps/dpnt-quotidien.json.gz", "rt") as f:
+        assert json.load(f) == EXPECTED_DPNT_ROWS
+
+    with gzip.open("dumps/dpnt-quotidien.csv.gz", "rt", newline="") as f:
+        assert list(csv.DictReader(f, delimiter=";")) == [
+            {key: "" if value is None else str(value) for key, value in row.items()}
+            | {"rpnt": ",".join(row["rpnt"] or [])}
+            for row in EXPECTED_DPNT_ROWS
+        ]
+
+
+@pytest.mark.parametrize(
+    ("min_orgs", "error"),
+    [(30000, "Not enough orgs"), (3, "File is too small")],
+)
+def test_create_new_dumps_rejected_in_production(dumps_dir, monkeypatch, min_orgs, error):
+    """Rejected dumps leave the previous ones in place, and no temporary file"""
+    monkeypatch.setenv("PRODUCTION", "1")
+    monkeypatch.setattr(sync, "PRODUCTION_DUMPS_MIN_ORGS", min_orgs)
+
+    with pytest.raises(Exception, match=error):
+        create_new_dumps(make_orgs())
+
+    assert sorted(os.listdir(dumps_dir)) == sorted(os.path.basename(p) for p in DUMP_PATHS)
+    for path in DUMP_PATHS:
+        with open(path) as f:
+            assert f.read() == "previous"
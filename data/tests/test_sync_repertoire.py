@@ -0,0 +1,193 @@
+import json
+from unittest.mock import patch
+
+import pytest
+import requests
+from requests.packages.urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from ..tasks import sync_repertoire
+from ..tasks.sync_repertoire import (
+    changed_fields,
+    is_transient_error,
+    update_repertoire_orga_members,
+    write_grist_records,
+)
+
+
+def test_changed_fields():
+    record = {"id": 1, "Libelle": "Ville", "Courriel": "", "PMUN_2025": 120.0}
+
+    assert changed_fields({"Libelle": "Ville", "Courriel": None, "PMUN_2025": 120}, record) == {}
+    assert changed_fields({"Libelle": "Ville", "PMUN_2025": 121}, record) == {"PMUN_2025": 121}
+    assert changed_fields({"Site_web": "https://ville.fr"}, record) == {
+        "Site_web": "https://ville.fr"
+    }
+
+
+class FakeGrist:
+    def __init__(self, tables, failures=0):
+        self.tables = tables
+        self.failures = failures
+        self.added = []
+        self.updated = []
+        self.deleted = []
+
+    def list_records(self, table_id, **kwargs):
+        return 200, self.tables[table_id]
+
+    def add_records(self, table_id, records):
+        self.added.extend(records)
+        return 200, None
+
+    def update_records(self, table_id, records):
+        for record in records:
+            record.pop("id")
+        if self.failures > 0:
+            self.failures -= 1
+            raise requests.ConnectionError("Connection reset by peer")
+        self.updated.extend(records)
+        return 200, None
+
+    def delete_rows(self, table_id, rows):
+        self.deleted.extend(rows)
+        return 200, None
+
+
+def test_update_repertoire_orga_members(tmp_path, monkeypatch):
+    """Only memberships created by the script, of BANATIC organisations, are deleted"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "dumps").mkdir()
+    (tmp_path / "dumps" / "groupements_memberships.json").write_text(
+        json.dumps(
+            [
+                {"N° SIREN": 250000001, "Siren membre": 210000001},
+                {"N° SIREN": 250000001, "Siren membre": 210000002},
+                {"N° SIREN": 250000009, "Siren membre": 210000001},
+            ]
+        )
+    )
+    grist = FakeGrist(
+        {
+            "ORGANISATIONS": [
+                {"id": 1, "SIREN": "250000001", "Libelle_BANATIC": "Syndicat"},
+                {"id": 2, "SIREN": "250000009", "Libelle_BANATIC": ""},
+            ],
+            "COLLECTIVITES": [
+                {"id": 11, "Numero_SIREN": "210000001"},
+                {"id": 12, "Numero_SIREN": "210000002"},
+                {"id": 13, "Numero_SIREN": "210000003"},
+            ],
+            "MEMBRES_ORGANISATIONS": [
+                # Up to date, by hand and by the script
+                {"id": 101, "Organisation": 1, "Membre_collectivite_": 11},
+                {
+                    "id": 105,
+                    "Organisation": 1,
+                    "Membre_collectivite_": 11,
+                    "Derniere_mise_a_jour_script_": "2025-01-01 00:00:00",
+                },
+                # No longer in BANATIC: created by the script, then by hand
+                {
+                    "id": 102,
+                    "Organisation": 1,
+                    "Membre_collectivite_": 13,
+                    "Derniere_mise_a_jour_script_": "2025-01-01 00:00:00",
+                },
+                {"id": 103, "Organisation": 1, "Membre_collectivite_": 13},
+                # Organisation without a BANATIC name
+                {
+                    "id": 104,
+                    "Organisation": 2,
+                    "Membre_collectivite_": 12,
+                    "Derniere_mise_a_jour_script_": "2025-01-01 00:00:00",
+                },
+            ],
+        }
+    )
+
+    with patch.object(sync_repertoire, "GristApi", return_value=grist):
+        update_repertoire_orga_members()
+
+    assert [(x["Organisation"], x["Membre_collectivite_"]) for x in grist.added] == [(1, 12)]
+    assert grist.deleted == [102]
+
+
+def test_update_repertoire_orga_members_skips_empty_dump(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "dumps").mkdir()
+    (tmp_path / "dumps" / "groupements_memberships.json").write_text("[]")
+
+    with patch.object(sync_repertoire, "GristApi") as grist_api:
+        update_repertoire_orga_members()
+    grist_api.assert_not_called()
+
+
+def test_update_repertoire_orga_members_refuses_mass_deletions(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "dumps").mkdir()
+    (tmp_path / "dumps" / "groupements_memberships.json").write_text(
+        json.dumps([{"N° SIREN": 250000001, "Siren membre": 210000000}])
+    )
+    collectivites = [{"id": 1000 + i, "Numero_SIREN": f"21{i:07d}"} for i in range(100)]
+    grist = FakeGrist(
+        {
+            "ORGANISATIONS": [{"id": 1, "SIREN": "250000001", "Libelle_BANATIC": "Syndicat"}],
+            "COLLECTIVITES": collectivites,
+            # Created by the script, but all missing from the (truncated) dump but one
+            "MEMBRES_ORGANISATIONS": [
+                {
+                    "id": 100 + i,
+                    "Organisation": 1,
+                    "Membre_collectivite_": collectivite["id"],
+                    "Derniere_mise_a_jour_script_": "2025-01-01 00:00:00",
+                }
+                for i, collectivite in enumerate(collectivites)
+            ],
+        }
+    )
+
+    with patch.object(sync_repertoire, "GristApi", return_value=grist):
+        with pytest.raises(Exception, match="Refusing to delete 99 of the 100 memberships"):
+            update_repertoire_orga_members()
+    assert grist.added == []
+    assert grist.deleted == []
+
+
+def test_write_grist_records_retries_transient_errors(monkeypatch):
+    monkeypatch.setattr(sync_repertoire.time, "sleep", lambda _: None)
+    grist = FakeGrist({}, failures=2)
+    records = [{"id": i, "Libelle": f"Commune {i}"} for i in range(1, 1201)]
+
+    with patch.object(sync_repertoire, "GristApi", return_value=grist):
+        write_grist_records("update_records", "COLLECTIVITES", records, "communes updated")
+
+    assert len(grist.updated) == 1200
+    # Retried batches still carry their record ids
+    assert all("id" in record for record in records)
+
+
+def test_is_transient_error():
+    def http_error(status_code):
+        response = requests.Response()
+        response.status_code = status_code
+        return requests.HTTPError(response=response)
+
+    refused = requests.ConnectionError(
+        MaxRetryError(None, "/", NewConnectionError(None, "Connection refused"))
+    )
+    reset = requests.ConnectionError("Connection reset by peer")
+
+    for method in ["update_records", "delete_rows"]:
+        assert is_transient_error(http_error(429), method)
+        assert is_transient_error(http_error(502), method)
+        assert is_transient_error(requests.ReadTimeout(), method)
+        assert is_transient_error(reset, method)
+        assert not is_transient_error(http_error(400), method)
+
+    # Grist may have applied a POST that failed after being sent
+    assert is_transient_error(http_error(429), "add_records")
+    assert is_transient_error(requests.ConnectTimeout(), "add_records")
+    assert is_transient_error(refused, "add_records")
+    assert not is_transient_error(http_error(502), "add_records")
+    assert not is_transient_error(requests.ReadTimeout(), "add_records")
+    assert not is_transient_error(reset, "add_records")
@@ -11,6 +11,10 @@ async function migrate() {
       ALTER TABLE data_checks ADD COLUMN IF NOT EXISTS metadata JSONB NOT NULL DEFAULT '{}';
     `);
 
+    await db.execute(sql`
+      ALTER TABLE data_checks ADD COLUMN IF NOT EXISTS content_hash TEXT;
+    `);
+
     // Rename structures tables/columns to operators (must run before adding new columns)
     await db.execute(sql`
       ALTER TABLE IF EXISTS st_mutualization_structures RENAME TO st_operators;
@@ -117,6 +121,41 @@ async function migrate() {
       ALTER TABLE st_services_to_operators ADD COLUMN IF NOT EXISTS position integer NOT NULL DEFAULT 0;
     `);
 
+    // Convert the snapshot history tables (see data/tasks/historize.py) to tables
+    // partitioned by history_month, moving each month of history to its own partition
+    await db.execute(sql`
+      DO $$
+      DECLARE
+        history_table text;
+        month text;
+      BEGIN
+        FOREACH history_table IN ARRAY ARRAY['st_organizations_history', 'data_rcpnt_stats_history'] LOOP
+          IF (SELECT relkind FROM pg_class WHERE oid = to_regclass(history_table)) = 'r' THEN
+            EXECUTE format('ALTER TABLE %I RENAME TO %I', history_table, history_table || '_legacy');
+            EXECUTE format(
+              'CREATE TABLE %I (LIKE %I) PARTITION BY LIST (history_month)',
+              history_table, history_table || '_legacy'
+            );
+            FOR month IN EXECUTE format('SELECT DISTINCT history_month FROM %I', history_table || '_legacy') LOOP
+              IF month IS NULL THEN
+                EXECUTE format(
+                  'CREATE TABLE %I PARTITION OF %I FOR VALUES IN (NULL)',
+                  history_table || '_none', history_table
+                );
+              ELSE
+                EXECUTE format(
+                  'CREATE TABLE %I PARTITION OF %I FOR VALUES IN (%L)',
+                  history_table || '_' || replace(month, '-', '_'), history_table, month
+                );
+              END IF;
+            END LOOP;
+            EXECUTE format('INSERT INTO %I SELECT * FROM %I', history_table, history_table || '_legacy');
+            EXECUTE format('DROP TABLE %I', history_table || '_legacy');
+          END IF;
+        END LOOP;
+      END $$;
+    `);
+
     console.log("Migration successful.");
     process.exit(0);
   } catch (error) {